@@ -9,7 +9,7 @@ import type {
   type,
   color,
 } from "./types.ts";
-import { encodeMove, decodeMove } from "./Tile.tsx";
+import { decodeMove } from "./Tile.tsx";
 import useChess, { calculateLegalMoves, generateFEN } from "./Chess.ts";
 import { promote } from "./PieceTypes/Pawn.ts";
 import pieces from "../assets/index";
@@ -99,20 +99,8 @@ const Board = () => {
 
   const engineMove = async () => {
     try {
-      // Iterate over all legal moves for each piece and collect in one set
-      // Moves are stored in UCI's long algebraic notation (e.g. 'e2e4')
-      const legalMoves = new Set<string>();
-      for (const [pieceId, moveSet] of moves ?? new Map()) {
-        const piece = getPieceData(boardData.current.tiles, pieceId);
-        if (!piece) continue;
-        const source = boardData.current.tiles[piece.rank * 8 + piece.file];
-        for (const move of moveSet) {
-          const target = boardData.current.tiles[+move];
-          legalMoves.add(encodeMove(source, target));
-        }
-      }
-
-      // Send board FEN & set of legal moves to engine to determine a move
+      // Send board FEN to engine to determine a move
+      // The server generates the legal moves itself
       const res = await fetch(`${import.meta.env.VITE_API_URL}/api/process`, {
         method: "POST",
         headers: {
@@ -120,7 +108,6 @@ const Board = () => {
         },
         body: JSON.stringify({
           fen: generateFEN(boardData.current),
-          moves: [...legalMoves],
         }),
       });
 
@@ -0,0 +1,304 @@
+import asyncio
+import json
+import os
+import time
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import ClientDisconnect, Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+import serving
+from metrics import REQUESTS, ERRORS, REQUEST_SECONDS, STAGE_SECONDS, REGISTRY, CallbackGauge
+
+# Async alternative to main.py with the same JSON contract, run with e.g.
+#   uvicorn asgi:app --port 5000
+
+MAX_CONTENT_LENGTH = 16 * 1024  # 16 KB
+BULK_MAX_JSON_LENGTH = 8 * 1024 * 1024  # 8 MB, NDJSON bodies are streamed & unbounded
+BULK_DEFAULT_TOP_K = 5
+MAX_CONCURRENT_INFERENCES = int(os.environ.get("MAX_CONCURRENT_INFERENCES", 32))
+MAX_QUEUE_DEPTH = int(os.environ.get("MAX_QUEUE_DEPTH", 256))
+RETRY_AFTER_S = int(os.environ.get("RETRY_AFTER_S", 1))
+
+# Inference blocks on the batcher, so it runs on its own threads and never on the event loop
+executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_INFERENCES, thread_name_prefix="inference")
+semaphore = asyncio.Semaphore(MAX_CONCURRENT_INFERENCES)
+
+in_flight = 0
+shed = 0
+
+REGISTRY.register(CallbackGauge("chess_asgi_in_flight", "Requests currently being handled", lambda: in_flight))
+REGISTRY.register(CallbackGauge("chess_asgi_shed_total", "Requests rejected with 503", lambda: shed, kind="counter"))
+
+def instrumented(path: str):
+    # Request counters & latency, labelled like the Flask app
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request: Request):
+            started = time.perf_counter()
+            try:
+                response = await handler(request)
+            except Exception as e:
+                ERRORS.inc(endpoint=path, type=type(e).__name__)
+                REQUESTS.inc(endpoint=path, status="500")
+                raise
+            REQUESTS.inc(endpoint=path, status=str(response.status_code))
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=path)
+            return response
+        return wrapper
+    return decorator
+
+async def read_json(request: Request, max_length: int = MAX_CONTENT_LENGTH):
+    # A malformed Content-Length raises ValueError, answered with a 400 like bad JSON
+    length = request.headers.get("content-length")
+    if length is not None and int(length) > max_length:
+        return None
+
+    body = b""
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > max_length:
+            return None
+    return json.loads(body) if body else {}
+
+async def read_lines(request: Request):
+    # Splits the body into non-empty lines as it arrives, left undecoded like main.read_lines
+    pending = b""
+    async for chunk in request.stream():
+        *lines, pending = (pending + chunk).split(b"\n")
+        for line in lines:
+            line = line.strip()
+            if line:
+                yield line
+    if pending.strip():
+        yield pending.strip()
+
+async def chunks(positions, size: int):
+    # Groups an async or plain iterable into lists of up to size items
+    chunk = []
+    if hasattr(positions, "__aiter__"):
+        async for position in positions:
+            chunk.append(position)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+    else:
+        for position in positions:
+            chunk.append(position)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+class DuplexResponse(StreamingResponse):
+    """
+    Streams a body iterator that may still be reading the request. Below ASGI
+    spec 2.4 (e.g. uvicorn), StreamingResponse listens for disconnects at the
+    same time and would take the request body messages the iterator waits for;
+    here a disconnect ends request.stream() instead.
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.stream_response(send)
+        except OSError:
+            raise ClientDisconnect()
+        if self.background is not None:
+            await self.background()
+
+def overloaded() -> JSONResponse | None:
+    global shed
+
+    # Requests waiting for an inference slot count towards the queue depth
+    if in_flight >= MAX_QUEUE_DEPTH:
+        shed += 1
+        return JSONResponse({"error": "Server busy"}, status_code=503, headers={"Retry-After": str(RETRY_AFTER_S)})
+    return None
+
+async def infer(fn, *args):
+    async with semaphore:
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+@instrumented("/api/process")
+async def move(request: Request):
+    global in_flight
+
+    busy = overloaded()
+    if busy is not None:
+        return busy
+
+    in_flight += 1
+    try:
+        with STAGE_SECONDS.time(stage="parse"):
+            try:
+                data = await read_json(request)
+            except ValueError:
+                return JSONResponse({"error": "Invalid JSON"}, status_code=400)
+            if data is None:
+                return JSONResponse({"error": "Request too large"}, status_code=413)
+
+            try:
+                fen, legal_moves = serving.resolve_position(data)
+            except ValueError as e:
+                return JSONResponse({"error": str(e)}, status_code=400)
+
+        if isinstance(data.get("search"), dict):
+            try:
+                best_move, search_stats = await infer(serving.search_move, fen, data["search"])
+            except ValueError as e:
+                return JSONResponse({"error": str(e)}, status_code=400)
+            return JSONResponse({
+                "move": best_move,
+                "search": search_stats
+            })
+        best_move = await infer(serving.select_move, fen, legal_moves)
+
+        return JSONResponse({
+            "move": best_move
+        })
+    finally:
+        in_flight -= 1
+
+@instrumented("/api/batch")
+async def batch(request: Request):
+    busy = overloaded()
+    if busy is not None:
+        return busy
+
+    try:
+        top_k = int(request.query_params.get("k", BULK_DEFAULT_TOP_K))
+    except ValueError:
+        top_k = BULK_DEFAULT_TOP_K
+    if top_k < 1:
+        return JSONResponse({"error": f"Invalid k: {top_k}"}, status_code=400)
+
+    # NDJSON bodies are consumed line by line while results stream back, so memory stays flat regardless of input size
+    if request.headers.get("content-type", "").split(";")[0].strip() == "application/x-ndjson":
+        positions = read_lines(request)
+    else:
+        try:
+            data = await read_json(request, BULK_MAX_JSON_LENGTH)
+        except ValueError:
+            return JSONResponse({"error": "Invalid JSON"}, status_code=400)
+        if data is None:
+            return JSONResponse({"error": "Request too large"}, status_code=413)
+        try:
+            positions = serving.batch_positions(data)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+
+    async def results():
+        global in_flight
+        in_flight += 1
+        try:
+            index = 0
+            async for chunk in chunks(positions, serving.BULK_BATCH_SIZE):
+                yield await infer(serving.score_chunk, chunk, top_k, index)
+                index += len(chunk)
+        except ClientDisconnect:
+            pass # nobody is left to read the results
+        finally:
+            in_flight -= 1
+
+    return DuplexResponse(results(), media_type="application/x-ndjson")
+
+@instrumented("/api/sessions")
+async def create_session(request: Request):
+    global in_flight
+
+    busy = overloaded()
+    if busy is not None:
+        return busy
+
+    in_flight += 1
+    try:
+        try:
+            data = await read_json(request)
+        except ValueError:
+            return JSONResponse({"error": "Invalid JSON"}, status_code=400)
+        if data is None:
+            return JSONResponse({"error": "Request too large"}, status_code=413)
+
+        try:
+            return JSONResponse(await infer(serving.create_session, data), status_code=201)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+    finally:
+        in_flight -= 1
+
+@instrumented("/api/sessions/{session_id}/move")
+async def session_move(request: Request):
+    global in_flight
+
+    busy = overloaded()
+    if busy is not None:
+        return busy
+
+    in_flight += 1
+    try:
+        try:
+            data = await read_json(request)
+        except ValueError:
+            return JSONResponse({"error": "Invalid JSON"}, status_code=400)
+        if data is None:
+            return JSONResponse({"error": "Request too large"}, status_code=413)
+
+        try:
+            result = await infer(serving.session_move, request.path_params["session_id"], data)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+        if result is None:
+            return JSONResponse({"error": "Unknown or expired session"}, status_code=404)
+        return JSONResponse(result)
+    finally:
+        in_flight -= 1
+
+@instrumented("/api/sessions/{session_id}")
+async def delete_session(request: Request):
+    if not serving.sessions.delete(request.path_params["session_id"]):
+        return JSONResponse({"error": "Unknown or expired session"}, status_code=404)
+    return Response(status_code=204)
+
+@instrumented("/api/stats")
+async def stats(request: Request):
+    return JSONResponse({
+        **serving.stats(),
+        "asgi": {
+            "in_flight": in_flight,
+            "shed": shed,
+            "max_concurrent_inferences": MAX_CONCURRENT_INFERENCES,
+            "max_queue_depth": MAX_QUEUE_DEPTH
+        }
+    })
+
+async def metrics(request: Request):
+    return PlainTextResponse(serving.metrics(), media_type="text/plain; version=0.0.4")
+
+async def profile(request: Request):
+    if not serving.PROFILER_ENABLED:
+        return JSONResponse({"error": "Profiler disabled, set PROFILER_ENABLED=1"}, status_code=404)
+    try:
+        seconds = float(request.query_params.get("seconds", 5))
+    except ValueError:
+        return JSONResponse({"error": "Invalid seconds"}, status_code=400)
+    return PlainTextResponse(await asyncio.to_thread(serving.profile, seconds))
+
+app = Starlette(
+    routes=[
+        Route("/api/process", move, methods=["POST"]),
+        Route("/api/batch", batch, methods=["POST"]),
+        Route("/api/sessions", create_session, methods=["POST"]),
+        Route("/api/sessions/{session_id}/move", session_move, methods=["POST"]),
+        Route("/api/sessions/{session_id}", delete_session, methods=["DELETE"]),
+        Route("/api/stats", stats, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+        Route("/debug/profile", profile, methods=["GET"])
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=serving.ORIGINS, allow_methods=["*"], allow_headers=["*"])
+    ]
+)
@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+import torch
+from policy import move_indices, pick_moves
+from metrics import STAGE_SECONDS, BATCH_SIZE
+
+class InferenceBatcher:
+    """
+    Collects positions from concurrent requests and runs them through the model
+    as a single batch. A batch is dispatched once it reaches max_batch_size or
+    once the oldest pending position has waited max_wait_ms.
+    """
+
+    def __init__(self, model: torch.nn.Module, device: torch.device, max_batch_size: int = 32, max_wait_ms: float = 2.0):
+        if max_batch_size < 1:
+            raise ValueError(f"Invalid batch size: {max_batch_size}")
+
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._closed = False
+
+        # Metrics
+        self._batches = 0
+        self._positions = 0
+        self._max_batch_seen = 0
+        self._batch_sizes = [0] * (max_batch_size + 1)
+
+    def _ensure_started(self):
+        # The worker thread is started lazily, and restarted after a fork
+        # (e.g. gunicorn --preload), since threads do not survive fork()
+        if self._pid == os.getpid() or self._closed:
+            return
+
+        with self._lock:
+            if self._pid == os.getpid() or self._closed:
+                return
+
+            self._queue = Queue()
+            worker = threading.Thread(target=self._run, args=(self._queue,), name="inference-batcher", daemon=True)
+            worker.start()
+            self._pid = os.getpid()
+
+    def submit(self, board: torch.Tensor, legal_moves: list[str]) -> Future:
+        """
+        Queues a single (13, 8, 8) board tensor. The returned future resolves to
+        the highest scoring move of legal_moves, or None if there are none.
+        """
+        self._ensure_started()
+        future = Future()
+        item = (board, legal_moves, future, time.perf_counter())
+        with self._lock:
+            if not self._closed:
+                self._queue.put(item)
+                return future
+
+        # A request that picked this batcher just before it was replaced is still answered by its model
+        self._process([item])
+        return future
+
+    def infer(self, board: torch.Tensor, legal_moves: list[str]) -> str | None:
+        return self.submit(board, legal_moves).result()
+
+    def close(self):
+        """
+        Stops the worker thread once the positions already queued are
+        evaluated, releasing the model. Later positions are evaluated one at a
+        time in the submitting thread.
+        """
+        with self._lock:
+            self._closed = True
+            if self._queue is not None and self._pid == os.getpid():
+                self._queue.put(None)
+
+    def stats(self) -> dict:
+        queue_depth = self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0
+        return {
+            "queue_depth": queue_depth,
+            "batches": self._batches,
+            "positions": self._positions,
+            "mean_batch_size": self._positions / self._batches if self._batches else 0.0,
+            "max_batch_size": self._max_batch_seen,
+            "batch_size_counts": {size: count for size, count in enumerate(self._batch_sizes) if count},
+            "config": {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000
+            }
+        }
+
+    def _run(self, queue: Queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.perf_counter() + self.max_wait
+
+            # Keep collecting until the batch is full or the window closes
+            closed = False
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = queue.get(timeout=remaining)
+                except Empty:
+                    break
+                if item is None:
+                    closed = True
+                    break
+                batch.append(item)
+
+            # Grab anything that is already waiting without blocking
+            while not closed and len(batch) < self.max_batch_size:
+                try:
+                    item = queue.get_nowait()
+                except Empty:
+                    break
+                if item is None:
+                    closed = True
+                    break
+                batch.append(item)
+
+            self._process(batch)
+            if closed:
+                return
+
+    def _process(self, batch: list):
+        futures = [future for _, _, future, _ in batch]
+        move_lists = [legal_moves for _, legal_moves, _, _ in batch]
+
+        start = time.perf_counter()
+        for _, _, _, submitted in batch:
+            STAGE_SECONDS.observe(start - submitted, stage="queue")
+        BATCH_SIZE.observe(len(batch))
+
+        try:
+            with torch.no_grad():
+                with STAGE_SECONDS.time(stage="stack"):
+                    boards = torch.stack([board for board, _, _, _ in batch]).to(self.device)
+                with STAGE_SECONDS.time(stage="forward"):
+                    logits = self.model(boards)
+                with STAGE_SECONDS.time(stage="mask"):
+                    indices, valid = move_indices(move_lists, self.device)
+                with STAGE_SECONDS.time(stage="decode"):
+                    best = pick_moves(logits, move_lists, indices, valid)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        for future, best_move in zip(futures, best):
+            future.set_result(best_move)
+
+        self._batches += 1
+        self._positions += len(batch)
+        self._max_batch_seen = max(self._max_batch_seen, len(batch))
+        self._batch_sizes[len(batch)] += 1
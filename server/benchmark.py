@@ -0,0 +1,340 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import chess
+import numpy as np
+import torch
+from dataset import encode_board, encode_boards, encode_move, decode_move, UCI_TO_INDEX, INDEX_TO_UCI
+from engine import ChessEngine, load_model
+from policy import move_indices, legal_mask
+
+# Results are nested dicts of numbers; keys ending in "_per_s" are throughputs
+# (higher is better), keys ending in "_us" or "_ms" are latencies (lower is better)
+
+DEFAULT_BATCH_SIZES = "1,2,4,8,16,32,64,128,256,512,1024"
+
+def legacy_encode_board(fen: str) -> torch.Tensor | None:
+    # Original per-square implementation, kept as the baseline
+    board = torch.tensor(()).new_zeros((13, 8, 8))
+    placements, active, castling_availability, ep_target, *_ = fen.split()
+
+    if not placements or not active or not castling_availability or not ep_target:
+        raise ValueError(f"Incorrect format: {fen}")
+
+    # Encode piece placements
+    PIECE_REPS = "PRNBQKprnbqk"
+    lines = placements.split('/')
+    rank = 7
+    for line in lines:
+        file = 0
+        for char in line:
+            if char.isdigit() and 1 <= int(char) <= 8:
+                file += int(char)
+            else:
+                piece_index = PIECE_REPS.index(char)  
+                board[piece_index][rank][file] = 1
+                file += 1
+        rank -= 1
+
+    # Encode color active
+    if active == 'b':
+        board[12][0][0] = 1
+    elif active != 'w': # active can only be 'w' or 'b'
+        raise ValueError(f"Invalid color: {active}")
+    
+    # Encode castling availability
+    if castling_availability != '-':
+        for castle in castling_availability:
+            match castle:
+                case 'K':
+                    board[12][0][1] = 1
+                case 'Q':
+                    board[12][0][2] = 1
+                case 'k':
+                    board[12][0][3] = 1
+                case 'q':
+                    board[12][0][4] = 1
+                case _:
+                    raise ValueError(f"Invalid castle: {castling_availability}")
+            
+    # Encode en passant target
+    if ep_target != '-':
+        if len(ep_target) != 2 or not 97 <= ord(ep_target[0]) <= 104 or not ep_target[1].isdigit() or (int(ep_target[1]) != 3 and int(ep_target[1]) != 6):
+            raise ValueError(f"Invalid en passant target: {ep_target}")
+        file, rank = ep_target[0], ep_target[1]
+        board[12][int(rank)][ord(file) - ord('a')] = 1
+
+    return board
+
+def sample_fens(n: int, seed: int = 0) -> list[str]:
+    """
+    Generates n reproducible positions by playing random legal moves.
+    """
+    rng = random.Random(seed)
+    fens = []
+    while len(fens) < n:
+        board = chess.Board()
+        for _ in range(rng.randint(0, 80)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+        fens.append(board.fen())
+    return fens
+
+def timeit(fn, repeats: int) -> float:
+    """
+    Returns the best wall-clock time of fn over repeats runs, in seconds.
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_encode(fens: list[str], repeats: int) -> dict:
+    # Both encoders must agree before their timings mean anything
+    for fen in fens:
+        if not torch.equal(legacy_encode_board(fen), encode_board(fen)):
+            raise AssertionError(f"Encoders disagree on {fen}")
+
+    buffer = torch.empty((len(fens), 13, 8, 8))
+    timings = {
+        "legacy_encode_board": timeit(lambda: [legacy_encode_board(fen) for fen in fens], repeats),
+        "encode_board": timeit(lambda: [encode_board(fen) for fen in fens], repeats),
+        "encode_boards": timeit(lambda: encode_boards(fens, out=buffer), repeats)
+    }
+
+    baseline = timings["legacy_encode_board"]
+    for name, seconds in timings.items():
+        print(f"{name:<20} {seconds / len(fens) * 1e6:8.2f} us/position  {baseline / seconds:6.1f}x")
+
+    return {name: {"position_us": seconds / len(fens) * 1e6} for name, seconds in timings.items()}
+
+def bench_moves(fens: list[str], repeats: int) -> dict:
+    ucis = [move.uci() for fen in fens for move in chess.Board(fen).legal_moves]
+    # decode_move does not invert the promotion indices, which can land on move
+    # types it rejects, so decoding is timed on the other moves
+    indices = [encode_move(uci) for uci in ucis if len(uci) == 4]
+
+    timings = {
+        "encode_move": timeit(lambda: [encode_move(uci) for uci in ucis], repeats),
+        "decode_move": timeit(lambda: [decode_move(index) for index in indices], repeats),
+        "uci_to_index": timeit(lambda: [UCI_TO_INDEX.get(uci) for uci in ucis], repeats),
+        "index_to_uci": timeit(lambda: [INDEX_TO_UCI[index] for index in indices], repeats)
+    }
+
+    counts = {"encode_move": len(ucis), "decode_move": len(indices), "uci_to_index": len(ucis), "index_to_uci": len(indices)}
+    for name, seconds in timings.items():
+        print(f"{name:<20} {seconds / counts[name] * 1e9:8.1f} ns/move")
+
+    return {name: {"move_us": seconds / counts[name] * 1e6} for name, seconds in timings.items()}
+
+def bench_mask(fens: list[str], batch_sizes: list[int], repeats: int) -> dict:
+    boards = [chess.Board(fen) for fen in fens]
+    results = {
+        "legal_moves": {
+            "position_us": timeit(lambda: [[move.uci() for move in board.legal_moves] for board in boards], repeats) / len(boards) * 1e6
+        }
+    }
+    print(f"{'legal_moves':<20} {results['legal_moves']['position_us']:8.2f} us/position")
+
+    move_lists = [[move.uci() for move in board.legal_moves] for board in boards]
+    for batch_size in batch_sizes:
+        batch = [move_lists[i % len(move_lists)] for i in range(batch_size)]
+        indices_s = timeit(lambda: move_indices(batch), repeats)
+        mask_s = timeit(lambda: legal_mask(batch), repeats)
+        results[f"batch_{batch_size}"] = {
+            "move_indices_us": indices_s * 1e6,
+            "legal_mask_us": mask_s * 1e6
+        }
+        print(f"mask batch {batch_size:<9} {indices_s * 1e6:10.1f} us move_indices  {mask_s * 1e6:10.1f} us legal_mask")
+
+    return results
+
+def bench_forward(model: torch.nn.Module, fens: list[str], batch_sizes: list[int], repeats: int) -> dict:
+    boards = encode_boards([fens[i % len(fens)] for i in range(max(batch_sizes))])
+    results = {}
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            batch = boards[:batch_size]
+            model(batch) # warm up
+            seconds = timeit(lambda: model(batch), repeats)
+            results[f"batch_{batch_size}"] = {
+                "batch_ms": seconds * 1000,
+                "positions_per_s": batch_size / seconds
+            }
+            print(f"forward batch {batch_size:<6} {seconds * 1000:10.3f} ms  {batch_size / seconds:12.0f} positions/s")
+    return results
+
+def load_test(url: str, fens: list[str], requests: int, concurrency: int, timeout: float = 30.0) -> dict:
+    """
+    Posts positions to /api/process from concurrency threads until requests
+    have been sent. Positions repeat once requests exceeds the number of FENs,
+    and repeats are answered from the server's position cache. Throughput and
+    latency percentiles cover successful responses only.
+    """
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+
+            body = json.dumps({"fen": fens[i % len(fens)]}).encode()
+            request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request, timeout=timeout) as response:
+                    response.read()
+                    status = response.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+            except OSError:
+                status = "connection_error"
+            elapsed = time.perf_counter() - start
+
+            # Failures (e.g. shed 503s) are only counted, their latency would skew the percentiles
+            with lock:
+                if isinstance(status, int) and 200 <= status < 300:
+                    latencies.append(elapsed)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    duration = time.perf_counter() - start
+
+    sent = sum(statuses.values())
+    results = {
+        "requests": sent,
+        "concurrency": concurrency,
+        "errors": sent - len(latencies),
+        "status_counts": statuses,
+        "duration_s": duration,
+        "requests_per_s": len(latencies) / duration
+    }
+    summary = f"load {url}: {results['requests_per_s']:.1f} req/s at concurrency {concurrency}"
+    if latencies:
+        p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+        results.update(p50_ms=p50, p95_ms=p95, p99_ms=p99)
+        summary += f", p50 {p50:.2f} ms, p95 {p95:.2f} ms, p99 {p99:.2f} ms"
+    print(f"{summary}, {results['errors']} errors")
+    return results
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain"], capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads()
+    }
+
+def flatten(results: dict, prefix: str = "") -> dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+def compare(baseline: dict, current: dict, tolerance: float) -> list[str]:
+    """
+    Prints the change of every timing shared by both result sets and returns
+    the ones that regressed by more than tolerance.
+    """
+    old, new = flatten(baseline["results"]), flatten(current["results"])
+    regressions = []
+    print(f"\nCompared with {baseline['environment'].get('commit')}:")
+    for key in sorted(old.keys() & new.keys()):
+        if key.endswith("_per_s"):
+            change = old[key] / new[key] - 1 if new[key] else float("inf")
+        elif key.endswith(("_us", "_ms")):
+            change = new[key] / old[key] - 1 if old[key] else 0.0
+        else:
+            continue
+
+        # change > 0 means slower, for latencies and throughputs alike
+        flag = ""
+        if change > tolerance:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        print(f"  {key:<50} {old[key]:12.3f} -> {new[key]:12.3f}  {change:+7.1%} slower{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for encoding, masking, inference & serving")
+    parser.add_argument("--suites", default="encode,moves,mask,forward", help="comma separated subset of encode,moves,mask,forward,load")
+    parser.add_argument("--positions", type=int, default=1000)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-sizes", default=DEFAULT_BATCH_SIZES)
+    parser.add_argument("--model", default="model.pt", help="weights for the forward benchmark, randomly initialized if missing")
+    parser.add_argument("--url", default="http://localhost:5000/api/process", help="endpoint for the load test")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--output", metavar="PATH", help="write results as JSON")
+    parser.add_argument("--compare", metavar="PATH", help="JSON results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="slowdown beyond which --compare fails")
+    args = parser.parse_args()
+
+    suites = args.suites.split(",")
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+
+    torch.set_num_threads(1)
+    fens = sample_fens(args.positions, args.seed)
+
+    results = {}
+    if "encode" in suites:
+        results["encode"] = bench_encode(fens, args.repeats)
+    if "moves" in suites:
+        results["moves"] = bench_moves(fens, args.repeats)
+    if "mask" in suites:
+        results["mask"] = bench_mask(fens, batch_sizes, args.repeats)
+    if "forward" in suites:
+        device = torch.device("cpu")
+        model = load_model(args.model, device) if os.path.exists(args.model) else ChessEngine().eval()
+        results["forward"] = bench_forward(model, fens, batch_sizes, args.repeats)
+    if "load" in suites:
+        results["load"] = load_test(args.url, fens, args.requests, args.concurrency)
+
+    report = {"environment": environment(), "config": vars(args), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.tolerance)
+        if regressions:
+            raise SystemExit(f"{len(regressions)} benchmarks regressed by more than {args.tolerance:.0%}")
+
+if __name__ == "__main__":
+    main()
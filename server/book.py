@@ -0,0 +1,211 @@
+import argparse
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import chess
+import chess.pgn
+import chess.polyglot
+import numpy as np
+import torch
+from engine import load_model, model_version
+from dataset import encode_boards
+from policy import move_indices, legal_policy
+from process_data import iter_shards, pgn_sources, submit_bounded
+
+# Open-addressing hash table of the model's top moves, keyed by the polyglot
+# Zobrist hash of the position. Key 0 marks an empty slot.
+TOP_K = 4
+LOAD_FACTOR = 0.5
+
+def entry_dtype(top_k: int) -> np.dtype:
+    # Moves are packed as from | to << 6 | promotion << 12, 0 for no move
+    return np.dtype([("key", "<u8"), ("moves", "<u2", (top_k,)), ("probs", "<f2", (top_k,))])
+
+def pack_move(move: chess.Move) -> int:
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+def unpack_move(packed: int) -> str:
+    return chess.Move(packed & 63, packed >> 6 & 63, packed >> 12 or None).uci()
+
+def meta_path(path: str) -> str:
+    return path + ".json"
+
+class OpeningBook:
+    """
+    Read-only view of a book built by build_book(). The table is memory-mapped,
+    so it costs no memory until probed and is shared between processes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.table = np.load(path, mmap_mode="r")
+        self.mask = len(self.table) - 1
+        with open(meta_path(path)) as f:
+            self.meta = json.load(f)
+
+        self.hits = 0
+        self.misses = 0
+
+    def probe(self, key: int) -> list[tuple[str, float]] | None:
+        # Linear probing from the slot given by the low bits of the key
+        slot = key & self.mask
+        while True:
+            entry = self.table[slot]
+            stored = int(entry["key"])
+            if stored == key:
+                return [(unpack_move(int(move)), float(p)) for move, p in zip(entry["moves"], entry["probs"]) if move]
+            if stored == 0:
+                return None
+            slot = (slot + 1) & self.mask
+
+    def lookup(self, fen: str) -> list[tuple[str, float]] | None:
+        """
+        Returns the book moves of a position with their probabilities, best
+        first, or None if the position is not in the book.
+        """
+        return self.probe(chess.polyglot.zobrist_hash(chess.Board(fen)))
+
+    def best_move(self, fen: str, legal_moves: list[str]) -> str | None:
+        entry = self.lookup(fen)
+        # The client's move list is authoritative, so a book move must appear in it
+        if entry and entry[0][0] in legal_moves:
+            self.hits += 1
+            return entry[0][0]
+        self.misses += 1
+        return None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "positions": self.meta["positions"],
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "build": self.meta
+        }
+
+def count_positions(games: list[bytes], max_ply: int) -> dict[int, list]:
+    """
+    Counts the positions reached within the first max_ply plies of each game.
+    Runs in a worker process; returns {zobrist hash: [fen, count]}.
+    """
+    positions = {}
+    for text in games:
+        game = chess.pgn.read_game(io.StringIO(text.decode("utf-8", errors="replace")))
+        if game is None:
+            continue
+
+        board = game.board()
+        for ply, move in enumerate(game.mainline_moves()):
+            if ply >= max_ply:
+                break
+            key = chess.polyglot.zobrist_hash(board)
+            entry = positions.get(key)
+            if entry is None:
+                positions[key] = [board.fen(), 1]
+            else:
+                entry[1] += 1
+            board.push(move)
+    return positions
+
+def build_book(positions: dict[int, list], model: torch.nn.Module, path: str, top_k: int = TOP_K, batch_size: int = 1024) -> int:
+    """
+    Evaluates every position and writes the table to path (a .npy file).
+    Returns the number of positions stored.
+    """
+    keys = [key for key in positions if key != 0]
+    capacity = 1 << max(int(len(keys) / LOAD_FACTOR - 1).bit_length(), 1)
+    table = np.zeros(capacity, dtype=entry_dtype(top_k))
+    mask = capacity - 1
+
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start:start + batch_size]
+        boards = [chess.Board(positions[key][0]) for key in batch]
+        move_lists = [list(board.legal_moves) for board in boards]
+
+        indices, valid = move_indices([[move.uci() for move in moves] for moves in move_lists])
+        if indices.shape[1] == 0:
+            continue
+        with torch.no_grad():
+            policy = legal_policy(model(encode_boards([positions[key][0] for key in batch])), indices, valid)
+            probs, cols = torch.topk(policy, k=min(top_k, policy.shape[1]), dim=1)
+
+        for key, moves, row_valid, row_probs, row_cols in zip(batch, move_lists, valid.tolist(), probs.tolist(), cols.tolist()):
+            top = [(moves[col], p) for p, col in zip(row_probs, row_cols) if row_valid[col]]
+            if not top:
+                continue
+
+            slot = key & mask
+            while table["key"][slot]:
+                slot = (slot + 1) & mask
+            table["key"][slot] = key
+            for i, (move, p) in enumerate(top):
+                table["moves"][slot, i] = pack_move(move)
+                table["probs"][slot, i] = p
+
+    # Written under a temporary name so a running server never maps a partial book
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, table)
+    os.replace(tmp_path, path)
+    return int((table["key"] != 0).sum())
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an opening book from the model's policy")
+    parser.add_argument("--raw-dir", default="data/raw")
+    parser.add_argument("--model", default="model.pt")
+    parser.add_argument("--output", default="book.npy")
+    parser.add_argument("--max-ply", type=int, default=12, help="positions reached within this many plies are stored")
+    parser.add_argument("--min-count", type=int, default=2, help="positions seen fewer times are left out")
+    parser.add_argument("--top-k", type=int, default=TOP_K)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--shard-mb", type=float, default=64)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    shard_bytes = int(args.shard_mb * 1024 * 1024)
+    tasks = (
+        (path, count_positions, games, args.max_ply)
+        for path in pgn_sources(args.raw_dir)
+        for _, games in iter_shards(path, shard_bytes)
+    )
+
+    positions = {}
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for _, counts in submit_bounded(pool, tasks, 2 * args.workers):
+            for key, (fen, count) in counts.items():
+                entry = positions.get(key)
+                if entry is None:
+                    positions[key] = [fen, count]
+                else:
+                    entry[1] += count
+
+    scanned = time.perf_counter()
+    seen = len(positions)
+    positions = {key: entry for key, entry in positions.items() if entry[1] >= args.min_count}
+
+    torch.set_num_threads(os.cpu_count())
+    model = load_model(args.model, torch.device("cpu"))
+    stored = build_book(positions, model, args.output, args.top_k)
+    built = time.perf_counter()
+
+    meta = {
+        "model": args.model,
+        "model_version": model_version(args.model),
+        "max_ply": args.max_ply,
+        "min_count": args.min_count,
+        "top_k": args.top_k,
+        "positions": stored,
+        "positions_seen": seen,
+        "scan_s": scanned - start,
+        "build_s": built - scanned
+    }
+    with open(meta_path(args.output), "w") as f:
+        json.dump(meta, f, indent=2)
+
+    print(f"Stored {stored} of {seen} positions seen in the first {args.max_ply} plies "
+          f"({os.path.getsize(args.output) / 2**20:.1f} MB) in {built - start:.1f}s (scan {meta['scan_s']:.1f}s, build {meta['build_s']:.1f}s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+from typing import Callable
+import chess
+
+def position_key(fen: str, legal_moves: list[str]) -> tuple[str, frozenset[str]]:
+    """
+    Normalizes a position to its placement, active color, castling & en passant
+    fields (the move clocks do not affect the model) plus its legal-move set.
+    """
+    return " ".join(fen.split()[:4]), frozenset(legal_moves)
+
+class PositionCache:
+    """
+    Bounded LRU cache of the move chosen for each position. Keys should
+    identify the model as well (see serving.cache_key), since model reloads are
+    handled by the model registry rather than here.
+    """
+
+    def __init__(self, max_size: int = 100_000):
+        self.max_size = max_size
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key) -> str | None:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value: str):
+        if self.max_size <= 0 or value is None:
+            return
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def warm(self, path: str, choose_moves: Callable[[list[str], list[list[str]]], list[str | None]], batch_size: int = 256,
+             key: Callable[[str, list[str]], object] = position_key) -> int:
+        """
+        Pre-fills the cache from a file of FENs, one per line ('#' starts a
+        comment). Legal moves are generated with python-chess and the positions
+        are evaluated in batches through choose_moves, and stored under
+        key(fen, legal_moves). Returns the number of positions added.
+        """
+        fens, move_lists = [], []
+        added = 0
+
+        def flush():
+            nonlocal added
+            for fen, legal_moves, best_move in zip(fens, move_lists, choose_moves(fens, move_lists)):
+                self.put(key(fen, legal_moves), best_move)
+                added += best_move is not None
+            fens.clear()
+            move_lists.clear()
+
+        with open(path) as f:
+            for line in f:
+                fen = line.split('#', 1)[0].strip()
+                if not fen:
+                    continue
+
+                board = chess.Board(fen)
+                fens.append(fen)
+                move_lists.append([move.uci() for move in board.legal_moves])
+
+                if len(fens) == batch_size:
+                    flush()
+
+        if fens:
+            flush()
+
+        return added
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions
+        }
@@ -1,8 +1,66 @@
 import os
+import bisect
+import json
+import chess
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+
+MANIFEST_NAME = "manifest.json"
+
+def read_manifest(data_dir: str) -> dict[str, int]:
+    """
+    Returns the per-chunk sample counts recorded by the preprocessor, keyed by
+    chunk name, or an empty dict if there is no manifest.
+    """
+    try:
+        with open(os.path.join(data_dir, MANIFEST_NAME)) as f:
+            return json.load(f)["chunks"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+def write_manifest(data_dir: str, chunks: dict[str, int]):
+    path = os.path.join(data_dir, MANIFEST_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"chunks": dict(sorted(chunks.items()))}, f, indent=1)
+    os.replace(tmp_path, path)
+
+class ChunkedDataset(Dataset):
+    """
+    Base for datasets split into chunk files. Samples are located through a
+    cumulative-offset array instead of a per-sample index.
+    """
+
+    def _build_index(self, file_sizes: list[int]):
+        self.file_sizes = file_sizes
+
+        # offsets[i] is the global index of the first sample of chunk i
+        self.offsets = np.cumsum([0] + file_sizes).tolist()
+        self.length = self.offsets[-1]
 
-class ChessDataset(Dataset):
+    def __len__(self):
+        return self.length
+
+    def _locate(self, idx):
+        if not 0 <= idx < self.length:
+            raise IndexError(idx)
+        file_idx = bisect.bisect_right(self.offsets, idx) - 1
+        return file_idx, idx - self.offsets[file_idx]
+
+    def load_chunk(self, file_idx: int):
+        """
+        Reads a whole chunk into memory, in whatever form chunk_batch expects.
+        """
+        raise NotImplementedError
+
+    def chunk_batch(self, chunk, local_indices: np.ndarray) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns the (boards, moves) tensors of the given samples of a loaded chunk.
+        """
+        raise NotImplementedError
+
+class ChessDataset(ChunkedDataset):
     def __init__(self, data_dir: str):
         # self.positions = positions
         self.data_dir = data_dir
@@ -16,31 +74,25 @@ class ChessDataset(Dataset):
         if not self.files:
             raise RuntimeError("No data files found")
 
-        # Index mapping: global_idx → (file_idx, local_idx)
-        self.index = []
-
-        self.length = 0
-        self.file_sizes = []
-
-        for file_idx, fname in enumerate(self.files):
-            path = os.path.join(data_dir, fname)
-            meta = torch.load(path, map_location="cpu")
+        # Sample counts come from the manifest; only unlisted chunks are opened
+        manifest = read_manifest(data_dir)
+        missing = [fname for fname in self.files if fname not in manifest]
+        for fname in missing:
+            meta = torch.load(os.path.join(data_dir, fname), map_location="cpu", mmap=True)
+            manifest[fname] = meta["moves"].shape[0]
 
-            n = meta["boards"].shape[0]
-            self.file_sizes.append(n)
+        if missing:
+            try:
+                write_manifest(data_dir, manifest)
+            except OSError:
+                pass
 
-            for local_idx in range(n):
-                self.index.append((file_idx, local_idx))
-
-            self.length += n
+        self._build_index([manifest[fname] for fname in self.files])
 
         # Do NOT keep file contents in memory
         self._cache = {}
         self._cache_size = 2  # number of chunks cached
 
-    def __len__(self):
-        return self.length
-    
     def _load_file(self, file_idx):
         if file_idx in self._cache:
             return self._cache[file_idx]
@@ -56,14 +108,292 @@ class ChessDataset(Dataset):
         return data
 
     def __getitem__(self, idx):
-        file_idx, local_idx = self.index[idx]
+        file_idx, local_idx = self._locate(idx)
         data = self._load_file(file_idx)
 
         board = data["boards"][local_idx]
         move = data["moves"][local_idx]
 
         return board, move
-    
+
+    def load_chunk(self, file_idx):
+        return torch.load(os.path.join(self.data_dir, self.files[file_idx]), map_location="cpu")
+
+    def chunk_batch(self, chunk, local_indices):
+        local_indices = torch.from_numpy(local_indices)
+        return chunk["boards"][local_indices].float(), chunk["moves"][local_indices].long()
+
+BOARDS_SUFFIX = ".boards.npy"
+MOVES_SUFFIX = ".moves.npy"
+
+def pack_boards(boards: np.ndarray) -> np.ndarray:
+    """
+    Packs (N, 13, 8, 8) 0/1 planes into a (N, 13) uint64 array, one bitboard
+    per plane with bit (rank * 8 + file) set for each occupied square.
+    """
+    bits = np.asarray(boards, dtype=np.uint8).reshape(-1, 13, 64)
+    packed = np.packbits(bits, axis=-1, bitorder="little")
+    return np.ascontiguousarray(packed).view("<u8").reshape(-1, 13)
+
+def unpack_boards(packed: np.ndarray) -> torch.Tensor:
+    """
+    Inverse of pack_boards, returns a (N, 13, 8, 8) float tensor.
+    """
+    words = np.ascontiguousarray(packed, dtype="<u8")
+    bits = np.unpackbits(words.view(np.uint8).reshape(-1, 13, 8), axis=-1, bitorder="little")
+    return torch.from_numpy(bits).view(-1, 13, 8, 8).float()
+
+def save_packed(path: str, boards: np.ndarray, moves: np.ndarray):
+    """
+    Writes a packed shard as <path>.boards.npy & <path>.moves.npy. The boards
+    file is written last, so its presence marks a complete shard.
+    """
+    write_packed(path, pack_boards(boards), moves)
+
+def write_packed(path: str, words: np.ndarray, moves: np.ndarray):
+    # Same as save_packed, for boards that are already packed
+    for suffix, array in ((MOVES_SUFFIX, np.asarray(moves, dtype="<i2")), (BOARDS_SUFFIX, np.asarray(words, dtype="<u8"))):
+        tmp_path = path + suffix + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path + suffix)
+
+class PackedChessDataset(ChunkedDataset):
+    """
+    Positions stored as bit-packed planes (13 uint64 per position) plus an int16
+    move label, read through memory maps and unpacked on access. Each position
+    takes 106 bytes on disk instead of the 3.3 KB of a float32 chunk.
+    """
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+
+        # Discover packed shards
+        self.files = sorted(
+            f[:-len(BOARDS_SUFFIX)] for f in os.listdir(data_dir)
+            if f.endswith(BOARDS_SUFFIX)
+        )
+
+        if not self.files:
+            raise RuntimeError("No data files found")
+
+        manifest = read_manifest(data_dir)
+        self._build_index([
+            manifest[name] if name in manifest else len(np.load(os.path.join(data_dir, name + MOVES_SUFFIX), mmap_mode="r"))
+            for name in self.files
+        ])
+
+        # Memory maps are opened lazily in each process, since pickling one
+        # (e.g. into a DataLoader worker) would copy the whole array
+        self._maps = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_maps"] = None
+        return state
+
+    @property
+    def boards(self) -> list[np.ndarray]:
+        return self._open()[0]
+
+    @property
+    def moves(self) -> list[np.ndarray]:
+        return self._open()[1]
+
+    def _open(self):
+        if self._maps is None:
+            paths = [os.path.join(self.data_dir, name) for name in self.files]
+            self._maps = (
+                [np.load(path + BOARDS_SUFFIX, mmap_mode="r") for path in paths],
+                [np.load(path + MOVES_SUFFIX, mmap_mode="r") for path in paths]
+            )
+        return self._maps
+
+    def __getitem__(self, idx):
+        file_idx, local_idx = self._locate(idx)
+        board = unpack_boards(self.boards[file_idx][local_idx:local_idx + 1])[0]
+        move = torch.tensor(int(self.moves[file_idx][local_idx]))
+        return board, move
+
+    def __getitems__(self, indices):
+        # Batched access used by DataLoader: one gather & unpack per shard touched
+        located = [self._locate(idx) for idx in indices]
+        by_file = {}
+        for pos, (file_idx, local_idx) in enumerate(located):
+            by_file.setdefault(file_idx, []).append((pos, local_idx))
+
+        boards = torch.empty((len(indices), 13, 8, 8))
+        moves = torch.empty(len(indices), dtype=torch.long)
+        for file_idx, entries in by_file.items():
+            positions = [pos for pos, _ in entries]
+            local = np.array([local_idx for _, local_idx in entries])
+            boards[positions] = unpack_boards(self.boards[file_idx][local])
+            moves[positions] = torch.from_numpy(self.moves[file_idx][local].astype(np.int64))
+
+        return list(zip(boards, moves))
+
+    def load_chunk(self, file_idx):
+        # Only the packed words are read; planes are unpacked per batch
+        return np.asarray(self.boards[file_idx]), np.asarray(self.moves[file_idx])
+
+    def chunk_batch(self, chunk, local_indices):
+        boards, moves = chunk
+        return unpack_boards(boards[local_indices]), torch.from_numpy(moves[local_indices].astype(np.int64))
+
+class ChunkShuffleStream(IterableDataset):
+    """
+    Streams whole batches from a ChunkedDataset while reading each chunk at most
+    once per epoch. Chunk order is shuffled, then chunks are loaded window at a
+    time and samples are shuffled across the loaded window. With DataLoader
+    workers, every worker streams a disjoint subset of the chunks, and with
+    distributed training (rank of world_size) so does every rank.
+
+    Use with DataLoader(stream, batch_size=None) and call set_epoch() before
+    each epoch to get a new order. The order only depends on the seed, epoch &
+    number of workers & ranks, so an epoch can be resumed part way with
+    skip_batches.
+    """
+
+    def __init__(self, dataset: ChunkedDataset, batch_size: int, window: int = 4, seed: int = 0, rank: int = 0, world_size: int = 1):
+        if not 0 <= rank < world_size:
+            raise ValueError(f"Invalid rank {rank} of {world_size}")
+
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.window = window
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.skip_batches = 0
+
+    def set_epoch(self, epoch: int, skip_batches: int = 0):
+        """
+        Selects the epoch to stream. skip_batches is the number of batches the
+        DataLoader already returned for this epoch, which are not read again.
+        """
+        self.epoch = epoch
+        self.skip_batches = skip_batches
+
+    def __len__(self):
+        # Exact with a single worker, one batch per extra worker short at most
+        return -(-len(self.dataset) // self.batch_size)
+
+    def _rank_chunk_ids(self) -> list[list[int]]:
+        order = np.random.default_rng((self.seed, self.epoch)).permutation(len(self.dataset.file_sizes))
+        if self.world_size == 1:
+            return [order.tolist()]
+
+        # Each chunk goes to the rank with the fewest samples so far, which keeps
+        # the ranks within one chunk of each other
+        rank_chunk_ids = [[] for _ in range(self.world_size)]
+        loads = [0] * self.world_size
+        for file_idx in order.tolist():
+            rank = loads.index(min(loads))
+            rank_chunk_ids[rank].append(file_idx)
+            loads[rank] += self.dataset.file_sizes[file_idx]
+        return rank_chunk_ids
+
+    def _worker_chunk_ids(self, num_workers: int, rank: int | None = None) -> list[list[int]]:
+        chunk_ids = self._rank_chunk_ids()[self.rank if rank is None else rank]
+        return [chunk_ids[worker::num_workers] for worker in range(num_workers)]
+
+    def _worker_batches(self, worker_chunk_ids: list[list[int]]) -> list[int]:
+        return [
+            -(-sum(self.dataset.file_sizes[file_idx] for file_idx in chunk_ids) // self.batch_size)
+            for chunk_ids in worker_chunk_ids
+        ]
+
+    def rank_batches(self, num_workers: int) -> int:
+        """
+        Number of batches every rank can stream this epoch. Distributed ranks
+        must take the same number of steps, so each stops after this many and
+        the shortfall of the smallest rank is dropped from the others.
+        """
+        return min(
+            sum(self._worker_batches(self._worker_chunk_ids(num_workers, rank)))
+            for rank in range(self.world_size)
+        )
+
+    def _worker_skips(self, worker_chunk_ids: list[list[int]]) -> tuple[list[int], int]:
+        # DataLoader returns batches from its workers in turn, passing over
+        # workers that have run out, so replay that to split skip_batches and
+        # find the worker whose turn is next
+        remaining = self._worker_batches(worker_chunk_ids)
+        skips = [0] * len(remaining)
+        left = min(self.skip_batches, sum(remaining))
+        worker = 0
+        while left:
+            if remaining[worker]:
+                remaining[worker] -= 1
+                skips[worker] += 1
+                left -= 1
+            worker = (worker + 1) % len(remaining)
+        return skips, worker
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+
+        worker_chunk_ids = self._worker_chunk_ids(num_workers)
+        skips, next_worker = self._worker_skips(worker_chunk_ids)
+
+        # A resumed DataLoader starts its round-robin at worker 0 again, so the
+        # workers are rotated for worker 0 to continue where the epoch stopped
+        worker = (worker + next_worker) % num_workers
+        chunk_ids = worker_chunk_ids[worker]
+        skip = skips[worker] * self.batch_size
+
+        parts = []
+        pending = 0
+        for start in range(0, len(chunk_ids), self.window):
+            window_ids = chunk_ids[start:start + self.window]
+            sizes = [self.dataset.file_sizes[file_idx] for file_idx in window_ids]
+            offsets = np.cumsum([0] + sizes)
+
+            # Windows that were fully consumed before resuming are never loaded
+            if skip >= offsets[-1]:
+                skip -= offsets[-1]
+                continue
+
+            rng = np.random.default_rng((self.seed, self.epoch, window_ids[0]))
+            order = rng.permutation(offsets[-1])[skip:]
+            skip = 0
+            chunks = [self.dataset.load_chunk(file_idx) for file_idx in window_ids]
+
+            # Batches are consecutive slices of the shuffled stream, crossing
+            # window boundaries where needed
+            position = 0
+            while position < len(order):
+                take = min(self.batch_size - pending, len(order) - position)
+                selected = order[position:position + take]
+                owners = np.searchsorted(offsets, selected, side="right") - 1
+                parts.extend(
+                    self.dataset.chunk_batch(chunks[j], selected[owners == j] - offsets[j])
+                    for j in np.unique(owners)
+                )
+                position += take
+                pending += take
+
+                if pending == self.batch_size:
+                    yield torch.cat([part[0] for part in parts]), torch.cat([part[1] for part in parts])
+                    parts = []
+                    pending = 0
+
+            del chunks
+
+        if parts:
+            yield torch.cat([part[0] for part in parts]), torch.cat([part[1] for part in parts])
+
+def open_dataset(data_dir: str) -> Dataset:
+    """
+    Opens data_dir with the packed format if it contains packed shards, or as
+    torch.save chunks otherwise.
+    """
+    if any(f.endswith(BOARDS_SUFFIX) for f in os.listdir(data_dir)):
+        return PackedChessDataset(data_dir)
+    return ChessDataset(data_dir)
+
 def encode_move(uci: str) -> int | None:
     if not 4 <= len(uci) <= 5:
         return
@@ -263,56 +593,195 @@ def decode_move(move_idx: int) -> str | None:
     return uci
 
 
-def encode_board(fen: str) -> torch.Tensor | None:
-    board = torch.tensor(()).new_zeros((13, 8, 8))
+NUM_MOVES = 4864 # 8 * 8 * 76
+
+def _build_move_tables() -> tuple[dict[str, int], list[str | None]]:
+    """
+    Enumerates every UCI string that encode_move accepts geometrically (queen
+    lines, knight jumps & promotions) and records its action index.
+    """
+    squares = [chr(f + 97) + str(r + 1) for r in range(8) for f in range(8)]
+    uci_to_index = {}
+
+    for src in range(64):
+        src_rank, src_file = divmod(src, 8)
+        for tgt in range(64):
+            tgt_rank, tgt_file = divmod(tgt, 8)
+            d_rank, d_file = abs(tgt_rank - src_rank), abs(tgt_file - src_file)
+            if src == tgt or not (d_rank == 0 or d_file == 0 or d_rank == d_file or {d_rank, d_file} == {1, 2}):
+                continue
+            uci = squares[src] + squares[tgt]
+            uci_to_index[uci] = encode_move(uci)
+
+    for src_rank, tgt_rank in ((6, 7), (1, 0)):
+        for src_file in range(8):
+            for tgt_file in range(max(src_file - 1, 0), min(src_file + 2, 8)):
+                for promotion in "nrbq":
+                    uci = squares[src_rank * 8 + src_file] + squares[tgt_rank * 8 + tgt_file] + promotion
+                    uci_to_index[uci] = encode_move(uci)
+
+    # A few promotions share an index with an ordinary move, in which case the
+    # ordinary move (enumerated first) is kept
+    index_to_uci = [None] * NUM_MOVES
+    for uci, idx in uci_to_index.items():
+        if index_to_uci[idx] is None:
+            index_to_uci[idx] = uci
+
+    return uci_to_index, index_to_uci
+
+# Precomputed lookups in both directions, consistent with encode_move
+UCI_TO_INDEX, INDEX_TO_UCI = _build_move_tables()
+
+
+PIECE_PLANES = {char: plane for plane, char in enumerate("PRNBQKprnbqk")}
+CASTLING_SQUARES = {'K': 1, 'Q': 2, 'k': 3, 'q': 4}
+PLANE_SIZE = 64
+BOARD_SIZE = 13 * PLANE_SIZE
+
+def board_squares(fen: str) -> list[int]:
+    """
+    Parses a FEN into the flat offsets (plane * 64 + rank * 8 + file) of every
+    square set in its 13x8x8 encoding.
+    """
     placements, active, castling_availability, ep_target, *_ = fen.split()
 
     if not placements or not active or not castling_availability or not ep_target:
         raise ValueError(f"Incorrect format: {fen}")
 
+    squares = []
+
     # Encode piece placements
-    PIECE_REPS = "PRNBQKprnbqk"
     lines = placements.split('/')
+    if len(lines) != 8:
+        raise ValueError(f"Invalid placements: {placements}")
     rank = 7
     for line in lines:
         file = 0
         for char in line:
-            if char.isdigit() and 1 <= int(char) <= 8:
-                file += int(char)
-            else:
-                piece_index = PIECE_REPS.index(char)  
-                board[piece_index][rank][file] = 1
-                file += 1
+            if '1' <= char <= '8':
+                file += ord(char) - 48
+                continue
+            plane = PIECE_PLANES.get(char)
+            if plane is None or file > 7:
+                raise ValueError(f"Invalid placements: {placements}")
+            squares.append(plane * PLANE_SIZE + rank * 8 + file)
+            file += 1
         rank -= 1
 
     # Encode color active
     if active == 'b':
-        board[12][0][0] = 1
+        squares.append(12 * PLANE_SIZE)
     elif active != 'w': # active can only be 'w' or 'b'
         raise ValueError(f"Invalid color: {active}")
-    
+
     # Encode castling availability
     if castling_availability != '-':
         for castle in castling_availability:
-            match castle:
-                case 'K':
-                    board[12][0][1] = 1
-                case 'Q':
-                    board[12][0][2] = 1
-                case 'k':
-                    board[12][0][3] = 1
-                case 'q':
-                    board[12][0][4] = 1
-                case _:
-                    raise ValueError(f"Invalid castle: {castling_availability}")
-            
+            if castle not in CASTLING_SQUARES:
+                raise ValueError(f"Invalid castle: {castling_availability}")
+            squares.append(12 * PLANE_SIZE + CASTLING_SQUARES[castle])
+
     # Encode en passant target
     if ep_target != '-':
-        if len(ep_target) != 2 or not 97 <= ord(ep_target[0]) <= 104 or not ep_target[1].isdigit() or (int(ep_target[1]) != 3 and int(ep_target[1]) != 6):
+        if len(ep_target) != 2 or not 97 <= ord(ep_target[0]) <= 104 or ep_target[1] not in "36":
             raise ValueError(f"Invalid en passant target: {ep_target}")
         file, rank = ep_target[0], ep_target[1]
-        board[12][int(rank)][ord(file) - ord('a')] = 1
+        squares.append(12 * PLANE_SIZE + int(rank) * 8 + ord(file) - ord('a'))
+
+    return squares
+
+def encode_board(fen: str) -> torch.Tensor | None:
+    board = np.zeros(BOARD_SIZE, dtype=np.uint8)
+    board[board_squares(fen)] = 1
+    return torch.from_numpy(board).view(13, 8, 8).float()
+
+def encode_boards(fens: list[str], out: torch.Tensor | None = None) -> torch.Tensor:
+    """
+    Encodes a batch of FENs into a (N, 13, 8, 8) float tensor. A preallocated
+    CPU tensor can be passed as out to be reused across batches.
+    """
+    if out is None:
+        out = torch.empty((len(fens), 13, 8, 8))
+    elif out.shape != (len(fens), 13, 8, 8) or out.device.type != "cpu":
+        raise ValueError(f"Invalid output buffer: {tuple(out.shape)} on {out.device}")
+
+    # The numpy view shares memory with out, so all squares are set in one write
+    buffer = out.numpy().reshape(-1)
+    buffer.fill(0)
+    offsets = [
+        row * BOARD_SIZE + square
+        for row, fen in enumerate(fens)
+        for square in board_squares(fen)
+    ]
+    buffer[offsets] = 1
+    return out
+
+PLANE_PIECES = [(piece_type, color) for color in (chess.WHITE, chess.BLACK) for piece_type in (chess.PAWN, chess.ROOK, chess.KNIGHT, chess.BISHOP, chess.QUEEN, chess.KING)]
+PIECE_PLANE_INDEX = {piece: plane for plane, piece in enumerate(PLANE_PIECES)}
+
+def chess_board_squares(board: chess.Board) -> list[int]:
+    """
+    Same as board_squares(board.fen()), read straight from the board's bitboards
+    without a FEN round trip.
+    """
+    squares = []
+    for plane, (piece_type, color) in enumerate(PLANE_PIECES):
+        offset = plane * PLANE_SIZE
+        squares.extend(offset + square for square in chess.scan_forward(board.pieces_mask(piece_type, color)))
+
+    squares.extend(state_squares(board))
+    return squares
+
+def state_squares(board: chess.Board) -> list[int]:
+    """
+    The flat offsets set in plane 12 (side to move, castling rights & en
+    passant target) for a board.
+    """
+    squares = []
+    if board.turn == chess.BLACK:
+        squares.append(12 * PLANE_SIZE)
+
+    for castle, has_rights in (
+        ('K', board.has_kingside_castling_rights(chess.WHITE)),
+        ('Q', board.has_queenside_castling_rights(chess.WHITE)),
+        ('k', board.has_kingside_castling_rights(chess.BLACK)),
+        ('q', board.has_queenside_castling_rights(chess.BLACK))
+    ):
+        if has_rights:
+            squares.append(12 * PLANE_SIZE + CASTLING_SQUARES[castle])
+
+    # board.fen() only lists the en passant square when the capture is legal
+    if board.ep_square is not None and board.has_legal_en_passant():
+        squares.append(12 * PLANE_SIZE + (chess.square_rank(board.ep_square) + 1) * 8 + chess.square_file(board.ep_square))
+
+    return squares
+
+def encode_chess_board(board: chess.Board) -> torch.Tensor:
+    encoded = np.zeros(BOARD_SIZE, dtype=np.uint8)
+    encoded[chess_board_squares(board)] = 1
+    return torch.from_numpy(encoded).view(13, 8, 8).float()
+
+def decode_board(planes) -> chess.Board:
+    """
+    Rebuilds the position of a 13x8x8 encoding (array or CPU tensor). Move
+    clocks are not encoded and start from zero.
+    """
+    board = chess.Board.empty()
+    castling = ""
+    for offset in np.flatnonzero(np.asarray(planes).reshape(-1)).tolist():
+        plane, square = divmod(offset, PLANE_SIZE)
+        if plane < 12:
+            piece_type, color = PLANE_PIECES[plane]
+            board.set_piece_at(square, chess.Piece(piece_type, color))
+        elif square == 0:
+            board.turn = chess.BLACK
+        elif square <= 4:
+            castling += "KQkq"[square - 1]
+        else:
+            # The en passant row is the target's rank number rather than its index
+            board.ep_square = square - 8
 
+    board.set_castling_fen(castling or "-")
     return board
 
 def encode_move_tensor(move: torch.Tensor) -> int | None:
@@ -0,0 +1,174 @@
+import argparse
+import heapq
+import json
+import os
+import shutil
+import time
+import numpy as np
+from dataset import NUM_MOVES, PackedChessDataset, write_packed, read_manifest, write_manifest, unpack_boards, decode_board, INDEX_TO_UCI
+
+# Zobrist-style tabulation hash over the packed planes: one random key per
+# (byte position, byte value), XORed together, plus an optional key per move
+HASH_SEED = 0x5EED
+_rng = np.random.default_rng(HASH_SEED)
+BYTE_KEYS = np.frombuffer(_rng.bytes(13 * 8 * 256 * 8), dtype="<u8").reshape(13 * 8, 256)
+MOVE_KEYS = np.frombuffer(_rng.bytes(NUM_MOVES * 8), dtype="<u8")
+
+HASH_BLOCK = 1 << 16 # positions hashed at once, bounds the lookup temporaries to ~50 MB
+RECORD = np.dtype([("hash", "<u8"), ("index", "<u8")])
+
+def position_hashes(words: np.ndarray, moves: np.ndarray | None = None) -> np.ndarray:
+    """
+    64-bit hashes of (N, 13) packed boards, and of their moves if given. Equal
+    positions always hash equally; move clocks are not part of the encoding.
+    """
+    hashes = np.empty(len(words), dtype=np.uint64)
+    byte_positions = np.arange(13 * 8)
+    for start in range(0, len(words), HASH_BLOCK):
+        block = np.ascontiguousarray(words[start:start + HASH_BLOCK], dtype="<u8").view(np.uint8).reshape(-1, 13 * 8)
+        hashes[start:start + len(block)] = np.bitwise_xor.reduce(BYTE_KEYS[byte_positions, block], axis=1)
+    if moves is not None:
+        hashes ^= MOVE_KEYS[np.asarray(moves, dtype=np.int64)]
+    return hashes
+
+def occurrence_ranks(hashes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    For hashes sorted so equal values are adjacent, returns the rank of each
+    entry within its run (0 for the first) and the start offset of every run.
+    """
+    starts = np.flatnonzero(np.r_[True, hashes[1:] != hashes[:-1]])
+    run_start = np.zeros(len(hashes), dtype=np.int64)
+    run_start[starts] = starts
+    return np.arange(len(hashes)) - np.maximum.accumulate(run_start), starts
+
+def deduplicate(in_dir: str, out_dir: str, cap: int, with_move: bool = False, buckets: int = 256) -> dict:
+    """
+    Copies a packed dataset, keeping at most cap samples of every position (or
+    position & move), the earliest ones in shard order. Runs in three passes
+    with memory bounded by the largest shard and bucket:
+
+    1. hash every sample and append (hash, index) to one of `buckets` run files
+       by the hash's top bits
+    2. sort each bucket by (hash, index) and mark samples past the cap in an
+       on-disk drop mask
+    3. rewrite every shard without its dropped samples
+
+    Duplicates are exact up to 64-bit hash collisions. Returns statistics.
+    """
+    if cap < 1:
+        raise ValueError(f"Invalid cap: {cap}")
+    if buckets & (buckets - 1):
+        raise ValueError(f"Buckets must be a power of two: {buckets}")
+
+    if os.path.realpath(in_dir) == os.path.realpath(out_dir):
+        raise ValueError("Deduplicated shards must be written to another directory")
+
+    start = time.perf_counter()
+    dataset = PackedChessDataset(in_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    tmp_dir = os.path.join(out_dir, ".dedup")
+    os.makedirs(tmp_dir, exist_ok=True)
+    shift = np.uint64(64 - buckets.bit_length() + 1)
+
+    # Pass 1: hash runs partitioned by bucket
+    run_paths = [os.path.join(tmp_dir, f"bucket_{bucket:05d}.bin") for bucket in range(buckets)]
+    runs = [open(path, "wb") for path in run_paths]
+    try:
+        for file_idx in range(len(dataset.files)):
+            hashes = position_hashes(dataset.boards[file_idx], dataset.moves[file_idx] if with_move else None)
+            records = np.empty(len(hashes), dtype=RECORD)
+            records["hash"] = hashes
+            records["index"] = np.arange(dataset.offsets[file_idx], dataset.offsets[file_idx + 1], dtype=np.uint64)
+
+            owners = (hashes >> shift).astype(np.int64) if buckets > 1 else np.zeros(len(hashes), dtype=np.int64)
+            order = np.argsort(owners, kind="stable")
+            records = records[order]
+            bounds = np.searchsorted(owners[order], np.arange(buckets + 1))
+            for bucket in np.flatnonzero(np.diff(bounds)):
+                records[bounds[bucket]:bounds[bucket + 1]].tofile(runs[bucket])
+    finally:
+        for run in runs:
+            run.close()
+    hashed = time.perf_counter()
+
+    # Pass 2: mark everything past the cap
+    dropped = np.lib.format.open_memmap(os.path.join(tmp_dir, "dropped.npy"), mode="w+", dtype=np.bool_, shape=(len(dataset),))
+    distinct = 0
+    histogram = {}
+    top = [] # (count, hash, first index) of the most repeated keys
+    for path in run_paths:
+        records = np.fromfile(path, dtype=RECORD)
+        os.remove(path)
+        if not len(records):
+            continue
+
+        records = records[np.lexsort((records["index"], records["hash"]))]
+        ranks, starts = occurrence_ranks(records["hash"])
+        dropped[records["index"][ranks >= cap].astype(np.int64)] = True
+
+        counts = np.diff(np.r_[starts, len(records)])
+        distinct += len(counts)
+        for bound, count in zip(*np.unique(np.minimum(counts, 1000), return_counts=True)):
+            histogram[int(bound)] = histogram.get(int(bound), 0) + int(count)
+        for run in np.argsort(counts)[-10:]:
+            heapq.heappush(top, (int(counts[run]), int(records["hash"][starts[run]]), int(records["index"][starts[run]])))
+            if len(top) > 10:
+                heapq.heappop(top)
+    dropped.flush()
+    marked = time.perf_counter()
+
+    # Pass 3: filtered copies of the shards
+    manifest = read_manifest(out_dir)
+    for file_idx, name in enumerate(dataset.files):
+        keep = ~dropped[dataset.offsets[file_idx]:dataset.offsets[file_idx + 1]]
+        write_packed(os.path.join(out_dir, name), dataset.boards[file_idx][keep], dataset.moves[file_idx][keep])
+        manifest[name] = int(keep.sum())
+    write_manifest(out_dir, manifest)
+
+    samples = len(dataset)
+    dropped_count = int(dropped.sum())
+    del dropped
+    shutil.rmtree(tmp_dir)
+
+    def describe(count, _, index):
+        file_idx, local_idx = dataset._locate(index)
+        board = decode_board(unpack_boards(dataset.boards[file_idx][local_idx:local_idx + 1])[0])
+        entry = {"count": count, "fen": board.fen()}
+        if with_move:
+            entry["move"] = INDEX_TO_UCI[int(dataset.moves[file_idx][local_idx])]
+        return entry
+
+    return {
+        "key": "position+move" if with_move else "position",
+        "cap": cap,
+        "samples": samples,
+        "kept": samples - dropped_count,
+        "dropped": dropped_count,
+        "dropped_fraction": dropped_count / samples if samples else 0.0,
+        "distinct": distinct,
+        # Number of distinct keys by occurrences (1000 stands for 1000 or more)
+        "occurrences": dict(sorted(histogram.items())),
+        "most_repeated": [describe(*entry) for entry in sorted(top, reverse=True)],
+        "timings_s": {
+            "hash": hashed - start,
+            "mark": marked - hashed,
+            "write": time.perf_counter() - marked
+        }
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Cap repeated positions in a packed dataset")
+    parser.add_argument("--in-dir", default="data/processed")
+    parser.add_argument("--out-dir", default="data/dedup")
+    parser.add_argument("--cap", type=int, default=1, help="samples kept per position")
+    parser.add_argument("--with-move", action="store_true", help="key on position & move, so each move of a position is capped separately")
+    parser.add_argument("--buckets", type=int, default=256, help="hash partitions sorted one at a time, more use less memory")
+    args = parser.parse_args()
+
+    stats = deduplicate(args.in_dir, args.out_dir, args.cap, args.with_move, args.buckets)
+    with open(os.path.join(args.out_dir, "dedup_stats.json"), "w") as f:
+        json.dump(stats, f, indent=2)
+    print(f"Kept {stats['kept']} of {stats['samples']} samples ({stats['dropped_fraction']:.1%} dropped, {stats['distinct']} distinct) in {sum(stats['timings_s'].values()):.1f}s")
+
+if __name__ == "__main__":
+    main()
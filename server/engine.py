@@ -1,11 +1,21 @@
+import argparse
+import hashlib
+import json
+import os
+import socket
+import time
+from contextlib import nullcontext
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
 from torch import optim
 import multiprocessing
 
-from dataset import ChessDataset
+from dataset import open_dataset, ChunkShuffleStream
 
 class ChessEngine(nn.Module):
     def __init__(self):
@@ -24,50 +34,308 @@ class ChessEngine(nn.Module):
         x = x.view(x.size(0), -1)
         return self.head(x)
 
-def main():
-    # Device
-    device = torch.device("mps") if torch.backends.mps.is_available() else torch.device("cpu")
+def load_model(path: str, device: torch.device, mmap: bool = False) -> nn.Module:
+    """
+    Loads either a ChessEngine state dict or an exported TorchScript artifact
+    (.ts, see export.py) for inference.
+
+    With mmap (CPU only), the weights are not copied into the process but
+    mapped read-only from the file, so every process serving the same file
+    shares one copy through the page cache.
+    """
+    if path.endswith(".ts"):
+        model = torch.jit.load(path, map_location=device)
+    elif mmap and device.type == "cpu":
+        # Parameters are created on the meta device and replaced by the mapped tensors
+        with torch.device("meta"):
+            model = ChessEngine()
+        model.load_state_dict(torch.load(path, map_location=device, mmap=True), assign=True)
+    else:
+        model = ChessEngine().to(device)
+        model.load_state_dict(torch.load(path, map_location=device))
+    model.eval()
+    # ScriptModules do not support requires_grad_(), so parameters are frozen one by one
+    for parameter in model.parameters():
+        parameter.requires_grad_(False)
+    return model
+
+def model_version(path: str) -> str:
+    # Content hash, so the version identifies the weights rather than the file name
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+AMP_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
+def save_checkpoint(path: str, state: dict):
+    # Written under a temporary name so a crash mid-save keeps the previous checkpoint
+    tmp_path = path + ".tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+def train(args, rank: int = 0, world_size: int = 1) -> dict:
+    """
+    Trains on the dataset, as one of world_size data-parallel ranks when
+    world_size > 1 (the process group must already be initialized). Returns the
+    training throughput over all ranks.
+    """
+    distributed = world_size > 1
+    log = print if rank == 0 else lambda *_, **__: None
+
+    # Device, gloo only runs on CPU
+    device = torch.device("mps") if torch.backends.mps.is_available() and not distributed else torch.device("cpu")
+    torch.manual_seed(args.seed)
 
     # Training objects
     model = ChessEngine().to(device)
     criterion = nn.CrossEntropyLoss()
-    optimizer = optim.Adam(model.parameters(), lr=1e-3)
+    optimizer = optim.Adam(model.parameters(), lr=args.lr)
+
+    # Tensors are loaded on the CPU, where the RNG state must stay; load_state_dict
+    # moves the model & optimizer state to the device
+    checkpoint = None
+    if args.resume and os.path.exists(args.checkpoint):
+        checkpoint = torch.load(args.checkpoint, map_location="cpu", weights_only=False)
+
+        # The data order depends on these, and the scaler state on amp, so the checkpointed values always win
+        for name in ("batch_size", "window", "seed", "workers", "amp"):
+            if getattr(args, name) != checkpoint["args"][name]:
+                log(f"Using --{name.replace('_', '-')} {checkpoint['args'][name]} from the checkpoint")
+            setattr(args, name, checkpoint["args"][name])
+
+    # fp16 needs loss scaling to keep small gradients from underflowing; bf16 does not
+    amp_dtype = AMP_DTYPES.get(args.amp)
+    scaler = torch.amp.GradScaler(device.type, enabled=args.amp == "fp16")
+
+    start_epoch, skip_batches, step = 0, 0, 0
+    epoch_loss = 0.0
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        scaler.load_state_dict(checkpoint["scaler"])
+        torch.set_rng_state(checkpoint["rng"])
+
+        start_epoch, skip_batches, step = checkpoint["epoch"], checkpoint["batches_done"], checkpoint["step"]
+        epoch_loss = checkpoint["epoch_loss"]
+
+        # Each rank streams different chunks, so a partial epoch only resumes on as many ranks
+        if checkpoint["args"].get("ranks", 1) != world_size and skip_batches:
+            log(f"Checkpoint was written with {checkpoint['args'].get('ranks', 1)} ranks, restarting epoch {start_epoch+1}")
+            skip_batches, epoch_loss = 0, 0.0
+        log(f"Resuming from epoch {start_epoch+1}, batch {skip_batches} (step {step})")
+
+    # Gradients are averaged across ranks during backward
+    ddp = DistributedDataParallel(model) if distributed else model
+    forward = torch.compile(ddp) if args.compile else ddp
 
     # Setup data loading for model
-    dataset = ChessDataset("data/processed")
+    dataset = open_dataset(args.data_dir)
+    if len(dataset.file_sizes) < world_size:
+        raise ValueError(f"{len(dataset.file_sizes)} chunks cannot be split across {world_size} ranks")
+
+    # Chunks are shuffled as blocks so each one is read once per epoch, by a single rank
+    stream = ChunkShuffleStream(dataset, batch_size=args.batch_size, window=args.window, seed=args.seed, rank=rank, world_size=world_size)
     loader = DataLoader(
-        dataset,
-        batch_size=1024,
-        shuffle=True
+        stream,
+        batch_size=None,
+        num_workers=min(args.workers, len(dataset.file_sizes) // world_size)
     )
 
+    def checkpoint_state(epoch, batches_done, running_loss):
+        return {
+            "model": model.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "scaler": scaler.state_dict(),
+            "rng": torch.get_rng_state(),
+            "args": vars(args),
+            "epoch": epoch,
+            "batches_done": batches_done,
+            "step": step,
+            "epoch_loss": running_loss
+        }
+
+    # Throughput is measured from the first optimizer step on, past compilation & loader startup
+    timed_start, timed_samples = None, 0
+    stopped = False
+
     # Training loop
-    EPOCHS = 5
-    for epoch in range(EPOCHS):
+    for epoch in range(start_epoch, args.epochs):
         model.train()
-        running_loss = 0.0
+        stream.set_epoch(epoch, skip_batches)
+
+        # Every rank takes the same number of steps, or the gradient all-reduce would hang
+        limit = stream.rank_batches(max(loader.num_workers, 1)) if distributed else None
 
+        # Loss stays on the device so no step has to wait for a host sync
+        running_loss = torch.zeros((), device=device)
+        num_batches = skip_batches
+        skip_batches = 0
+        start = time.perf_counter()
+
+        optimizer.zero_grad(set_to_none=True)
         for boards, moves in loader:
-            boards = boards.to(device)
-            moves = moves.to(device)
+            if num_batches == limit:
+                break
+
+            boards = boards.to(device, non_blocking=True)
+            moves = moves.to(device, non_blocking=True)
+
+            # Gradients are only all-reduced on the last batch before an optimizer step
+            sync = (num_batches + 1) % args.accum_steps == 0 or num_batches + 1 == limit
+            with ddp.no_sync() if distributed and not sync else nullcontext():
+                with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                    outputs = forward(boards)
+                    loss = criterion(outputs, moves)
+
+                scaler.scale(loss / args.accum_steps).backward()
+            running_loss += loss.detach()
+            num_batches += 1
+            if timed_start is not None:
+                timed_samples += boards.shape[0]
+
+            # Gradient accumulation: one optimizer step per accum_steps batches
+            if num_batches % args.accum_steps:
+                continue
+
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
+            step += 1
+            if timed_start is None:
+                timed_start = time.perf_counter()
+
+            if args.checkpoint_every and step % args.checkpoint_every == 0 and rank == 0:
+                save_checkpoint(args.checkpoint, checkpoint_state(epoch, num_batches, epoch_loss + running_loss.item()))
+
+            if args.max_steps and step >= args.max_steps:
+                stopped = True
+                break
+
+        # Apply gradients left over from an incomplete accumulation
+        if num_batches % args.accum_steps:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
+            step += 1
 
-            optimizer.zero_grad()
+        # Calculate loss, averaged over all ranks
+        if distributed:
+            dist.all_reduce(running_loss)
+            running_loss /= world_size
+        avg_loss = (epoch_loss + running_loss.item()) / max(num_batches, 1)
+        elapsed = time.perf_counter() - start
+        log(f"Epoch {epoch+1}/{args.epochs} | Loss: {avg_loss:.4f} | {elapsed:.1f}s")
+        epoch_loss = 0.0
 
-            outputs = model(boards)
-            loss = criterion(outputs, moves)
+        if args.checkpoint_every and rank == 0:
+            finished = checkpoint_state(epoch, num_batches, avg_loss * num_batches) if stopped else checkpoint_state(epoch + 1, 0, 0.0)
+            save_checkpoint(args.checkpoint, finished)
 
-            loss.backward()
-            optimizer.step()
+        if stopped:
+            break
 
-            running_loss += loss.item()
+    # Save model, atomically since a running server may be watching the file
+    if args.output and rank == 0:
+        save_checkpoint(args.output, model.state_dict())
+
+    elapsed = time.perf_counter() - timed_start if timed_start is not None else 0.0
+    samples, elapsed = torch.tensor([float(timed_samples)]), torch.tensor([elapsed])
+    if distributed:
+        dist.all_reduce(samples)
+        dist.all_reduce(elapsed, op=dist.ReduceOp.MAX)
+    samples, elapsed = samples.item(), elapsed.item()
+    return {
+        "ranks": world_size,
+        "samples": int(samples),
+        "elapsed_s": elapsed,
+        "samples_per_s": samples / elapsed if elapsed else 0.0
+    }
+
+def train_rank(rank: int, world_size: int, args, results=None):
+    # Entry point of each process started by launch()
+    torch.set_num_threads(args.threads or max(1, os.cpu_count() // world_size))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        stats = train(args, rank, world_size)
+        if rank == 0 and results is not None:
+            results.put(stats)
+    finally:
+        dist.destroy_process_group()
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def launch(args, world_size: int) -> dict:
+    """
+    Trains with world_size local processes, data-parallel over gloo.
+    """
+    if world_size == 1:
+        return train(args)
+
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(free_port())
+    results = mp.get_context("spawn").SimpleQueue()
+    mp.spawn(train_rank, args=(world_size, args, results), nprocs=world_size)
+    return results.get()
+
+def scaling_report(args, rank_counts: list[int]) -> list[dict]:
+    """
+    Trains for args.max_steps steps at each number of ranks and compares the
+    throughput against the smallest run.
+    """
+    args.checkpoint_every = 0
+    args.resume = False
+    args.output = None
+
+    report = []
+    for world_size in rank_counts:
+        stats = launch(args, world_size)
+        # Relative to the per-rank throughput of the first run
+        first = report[0] if report else stats
+        per_rank = first["samples_per_s"] / first["ranks"]
+        stats["speedup"] = stats["samples_per_s"] / per_rank if per_rank else 0.0
+        stats["efficiency"] = stats["speedup"] / world_size
+        report.append(stats)
+        print(f"{world_size} ranks | {stats['samples_per_s']:.0f} samples/s | speedup {stats['speedup']:.2f}x | efficiency {stats['efficiency']:.0%}", flush=True)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Train ChessEngine")
+    parser.add_argument("--data-dir", default="data/processed")
+    parser.add_argument("--output", default="model.pt")
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--window", type=int, default=4, help="chunks shuffled together")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--amp", choices=["none", "bf16", "fp16"], default="none", help="autocast precision")
+    parser.add_argument("--compile", action="store_true", help="run the model through torch.compile")
+    parser.add_argument("--accum-steps", type=int, default=1, help="batches per optimizer step")
+    parser.add_argument("--checkpoint", default="checkpoint.pt")
+    parser.add_argument("--checkpoint-every", type=int, default=1000, help="optimizer steps between checkpoints, 0 disables")
+    parser.add_argument("--resume", action="store_true", help="continue from --checkpoint if it exists")
+    parser.add_argument("--ranks", type=int, default=1, help="local processes for data-parallel training on CPU (DDP over gloo)")
+    parser.add_argument("--threads", type=int, default=0, help="torch threads per rank, 0 splits the cores evenly")
+    parser.add_argument("--max-steps", type=int, default=0, help="stop after this many optimizer steps, 0 trains every epoch")
+    parser.add_argument("--scaling", metavar="RANKS", help="measure throughput at e.g. 1,2,4,8 ranks for --max-steps steps each instead of training")
+    parser.add_argument("--scaling-report", default="scaling_report.json")
+    args = parser.parse_args()
 
-        # Calculate loss
-        avg_loss = running_loss / len(loader)
-        print(f"Epoch {epoch+1}/{EPOCHS} | Loss: {avg_loss:.4f}")
+    if args.scaling:
+        args.max_steps = args.max_steps or 100
+        report = scaling_report(args, [int(ranks) for ranks in args.scaling.split(",")])
+        with open(args.scaling_report, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.scaling_report}")
+        return
 
-    # Save model
-    torch.save(model.state_dict(), "model.pt")
+    launch(args, args.ranks)
 
 if __name__ == "__main__":
     multiprocessing.freeze_support()
-    main()
\ No newline at end of file
+    main()
@@ -1,88 +1,195 @@
+import argparse
+import io
+import json
 import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import chess.pgn
+import numpy as np
 import torch
-from engine import ChessEngine
-from dataset import encode_move, decode_move, encode_board
+import torch.nn.functional as F
+from engine import load_model
+from dataset import BOARD_SIZE, UCI_TO_INDEX, open_dataset, decode_board, chess_board_squares
+from policy import move_indices, legal_mask, legal_logits
+from process_data import iter_shards, submit_bounded
 
-def main():
-    device = torch.device("mps") if torch.backends.mps.is_available() else torch.device("cpu")
-    model = ChessEngine().to(device)
-
-    model.load_state_dict(torch.load("model.pt"))
-    model.eval()
-
-    # (FEN, legal_moves)
-    sample_game = [
-        ("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", 
-            [
-                "a2a3", "a2a4", "b2b3", "b2b4", "c2c3", "c2c4", "d2d3", "d2d4", "e2e3", "e2e4", "f2f3", "f2f4", "g2g3", "g2g4", "h2h3", "h2h4", "b1a3", "b1c3", "g1f3", "g1h3" 
-            ]
-        ),
-        ("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1",
-            [
-                "b8a6", "b8c6", "g8f6", "g8h6", "a7a6", "a7a5", "b7b6", "b7b5", "c7c6", "c7c5", "d7d6", "d7d5", "e7e6", "e7e5", "f7f6", "f7f5", "g7g6", "g7g5", "h7h6", "h7h5"
-            ]
-        ),
-        ("rnbqkbnr/pp1ppppp/8/2p5/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2",
-            [
-                "a2a3", "a2a4", "b2b3", "b2b4", "c2c3", "c2c4", "d2d3", "d2d4", "e4e5", "f2f3", "f2f4", "g2g3", "g2g4", "h2h3", "h2h4", "b1a3", "b1c3", "d1e2", "d1f3", "d1g4", "d1h5", "e1e2", "f1e2", "f1d3", "f1c4", "f1b5", "f1a6", "g1e2", "g1f3", "g1h3" 
-            ]
-        ),
-        ("rnbqkbnr/pp1ppppp/8/2p5/4P3/5N2/PPPP1PPP/RNBQKB1R b KQkq - 1 2",
-            [
-                "b8a6", "b8c6", "d8c7", "d8b6", "d8a5", "g8f6", "g8h6", "a7a6", "a7a5", "b7b6", "b7b5", "c5c4", "d7d6", "d7d5", "e7e6", "e7e5", "f7f6", "f7f5", "g7g6", "g7g5", "h7h6", "h7h5"
-            ]
-        ),
-        ("r1bqkbnr/pp1ppppp/2n5/2p5/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3",
-            [
-                "a2a3", "a2a4", "b2b3", "b2b4", "c2c3", "c2c4", "d2d3", "d2d4", "e4e5", "g2g3", "g2g4", "h2h3", "h2h4", "b1a3", "b1c3", "d1e2", "e1e2", "f1e2", "f1d3", "f1c4", "f1b5", "f1a6", "f3g5", "f3h4", "f3g1", "f3d4", "f3e5", "h1g1"
-            ]
-        ),
-        ("r1bqkbnr/pp1ppppp/2n5/2p5/2B1P3/5N2/PPPP1PPP/RNBQKB1R b KQkq - 3 3",
-            [
-                "a8b8", "d8c7", "d8b6", "d8a5", "g8f6", "g8h6", "a7a6", "a7a5", "b7b6", "b7b5", "d7d6", "d7d5", "e7e6", "e7e5", "f7f6", "f7f5", "g7g6", "g7g5", "h7h6", "h7h5", "c6e5", "c6d4", "c6b4", "c6a5", "c6b8"
-            ]
-        ),
-        ("r1bqkbnr/pp1p1ppp/2n1p3/2p5/2B1P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 0 4",
-            [
-                "c4d5", "c4d3", "c4e2", "c4f1", "c4b3", "c4b5", "c4a6", "e4e5", "f3g5", "f3h4", "f3g1", "f3d4", "f3e5", "a2a3", "a2a4", "b2b3", "b2b4", "c2c3", "c2c4", "d2d3", "d2d4", "g2g3", "g2g4", "h2h3", "h2h4", "b1a3", "b1c3", "d1e2", "e1e2", "e1f1", "h1g1", "h1f1"
-            ]
-        ),
-        ("r1bqkbnr/pp1p1ppp/2n1p3/2p5/2B1P3/2P2N2/PP1P1PPP/RNBQKB1R b KQkq - 0 4",
-            [
-                "a8b8", "d8e7", "d8f6", "d8g5", "d8h4", "d8c7", "d8b6", "d8a5", "e8e7", "f8e7", "f8d6", "g8h6", "g8f6", "g8e7", "a7a6", "a7a5", "b7b6", "b7b5", "d7d6", "d7d5", "f7f6", "f7f5", "g7g6", "g7g5", "h7h6", "h7h5", "c6e7", "c6e5", "c6d4", "c6b4", "c6a5", "c6b8", "e6e5"
-            ]
-        ),
-        ("r1bqkbnr/p2p1ppp/2n1p3/1pp5/2B1P3/2P2N2/PP1P1PPP/RNBQKB1R w KQkq - 0 5",
-            [
-                "c4d5", "c4d3", "c4e2", "c4f1", "c4b3", "e4e5", "f3g5", "f3h4", "f3g1", "f3d4", "f3e5", "a2a3", "a2a4", "b2b3", "b2b4", "d2d3", "d2d4", "g2g3", "g2g4", "h2h3", "h2h4", "b1a3", "d1e2", "d1c2", "d1b3", "d1a4", "e1e2", "e1f1", "h1g1", "h1f1"
-            ]
-        ),
-        ("r1bqkbnr/p2p1ppp/2n1p3/1pp5/4P3/1BP2N2/PP1P1PPP/RNBQKB1R b KQkq - 1 5",
-            [
-                "a8b8", "c8b7", "c8a6", "d8e7", "d8f6", "d8g5", "d8h4", "d8c7", "d8b6", "d8a5", "e8e7", "f8e7", "f8d6", "g8h6", "g8f6", "g8e7", "a7a6", "a7a5", "d7d6", "d7d5", "f7f6", "f7f5", "g7g6", "g7g5", "h7h6", "h7h5", "c6e7", "c6e5", "c6d4", "c6b4", "c6a5", "c6b8", "e6e5", "b5b4", "c5c4"
-            ]
-        )
-    ]
+PHASES = ["opening", "middlegame", "endgame"]
+
+# Non-pawn material per plane ("PRNBQKprnbqk"), 24 in the starting position
+PHASE_WEIGHTS = torch.tensor([0, 2, 1, 1, 4, 0, 0, 2, 1, 1, 4, 0], dtype=torch.float32)
+OPENING_MATERIAL = 22
+ENDGAME_MATERIAL = 8
+
+# Per-process state, set up once by init_worker
+model = None
+device = None
+dataset = None
+
+def init_worker(model_path: str, device_name: str, threads: int, data_dir: str | None):
+    global model, device, dataset
+    torch.set_num_threads(threads)
+    device = torch.device(device_name)
+    model = load_model(model_path, device)
+    dataset = open_dataset(data_dir) if data_dir else None
+
+def game_phase(boards: torch.Tensor) -> torch.Tensor:
+    """
+    Classifies each (13, 8, 8) board by the non-pawn material left on it:
+    0 opening, 1 middlegame, 2 endgame.
+    """
+    material = boards[:, :12].sum(dim=(2, 3)) @ PHASE_WEIGHTS
+    return (material < OPENING_MATERIAL).long() + (material <= ENDGAME_MATERIAL).long()
 
+def evaluate_batch(boards: torch.Tensor, targets: torch.Tensor, move_lists: list[list[str]] | None, totals: dict):
+    """
+    Scores one batch against the moves actually played and adds per-phase sums
+    to totals. Legal move metrics are only computed when move_lists is given.
+    """
     with torch.no_grad():
-        for board, legal_moves in sample_game:
-            board_tensor = encode_board(board).unsqueeze(0).to(device)
-            logits = model(board_tensor)[0]
-            policy = torch.softmax(logits, dim=0)
+        logits = model(boards.to(device)).float()
+    targets = targets.to(device)
+    log_probs = F.log_softmax(logits, dim=1)
+
+    top5 = logits.topk(5, dim=1).indices
+    sums = {
+        "positions": torch.ones_like(targets, dtype=torch.float32),
+        "top1": (top5[:, 0] == targets).float(),
+        "top5": (top5 == targets[:, None]).any(dim=1).float(),
+        "nll": -log_probs.gather(1, targets[:, None]).squeeze(1)
+    }
+
+    if move_lists is not None:
+        indices, valid = move_indices(move_lists, device)
+        sums["legal_mass"] = log_probs.exp().masked_fill(~legal_mask(move_lists, device), 0).sum(dim=1)
+
+        # Best legal moves by column, mapped back to action indices
+        k = min(5, indices.shape[1])
+        cols = legal_logits(logits, indices, valid).topk(k, dim=1).indices
+        hits = (indices.gather(1, cols) == targets[:, None]) & valid.gather(1, cols)
+        sums["legal_top1"] = hits[:, 0].float() if k else torch.zeros_like(sums["top1"])
+        sums["legal_top5"] = hits.any(dim=1).float()
+
+    phases = game_phase(boards).to(device)
+    for name, values in sums.items():
+        per_phase = torch.bincount(phases, weights=values, minlength=len(PHASES)).tolist()
+        totals[name] = [a + b for a, b in zip(totals.get(name, [0.0] * len(PHASES)), per_phase)]
+
+def evaluate_chunk(file_idx: int, batch_size: int, legal: bool) -> dict:
+    """
+    Evaluates every sample of one chunk of the processed dataset.
+    """
+    totals = {}
+    chunk = dataset.load_chunk(file_idx)
+    size = dataset.file_sizes[file_idx]
+    for start in range(0, size, batch_size):
+        boards, targets = dataset.chunk_batch(chunk, np.arange(start, min(start + batch_size, size)))
+        move_lists = [[move.uci() for move in decode_board(board).legal_moves] for board in boards] if legal else None
+        evaluate_batch(boards, targets, move_lists, totals)
+    return totals
+
+def evaluate_games(games: list[bytes], batch_size: int, legal: bool) -> dict:
+    """
+    Evaluates every position of the mainline of each game against the move
+    played from it.
+    """
+    totals = {}
+    squares, targets, move_lists = [], [], []
+
+    def flush():
+        boards = np.zeros((len(squares), BOARD_SIZE), dtype=np.float32)
+        for row, row_squares in enumerate(squares):
+            boards[row, row_squares] = 1
+        evaluate_batch(torch.from_numpy(boards).view(-1, 13, 8, 8), torch.tensor(targets), move_lists if legal else None, totals)
+        squares.clear()
+        targets.clear()
+        move_lists.clear()
+
+    for text in games:
+        game = chess.pgn.read_game(io.StringIO(text.decode("utf-8", errors="replace")))
+        if game is None:
+            continue
+
+        board = game.board()
+        for move in game.mainline_moves():
+            move_idx = UCI_TO_INDEX.get(move.uci())
+            if move_idx is not None:
+                squares.append(chess_board_squares(board))
+                targets.append(move_idx)
+                if legal:
+                    move_lists.append([legal_move.uci() for legal_move in board.legal_moves])
+                if len(targets) == batch_size:
+                    flush()
+            board.push(move)
+
+    if targets:
+        flush()
+    return totals
+
+def merge(totals: dict, other: dict):
+    for name, values in other.items():
+        totals[name] = [a + b for a, b in zip(totals.get(name, [0.0] * len(PHASES)), values)]
+
+def summarize(totals: dict) -> dict:
+    """
+    Turns per-phase sums into rates, overall and by phase.
+    """
+    def rates(sums: dict) -> dict:
+        n = sums["positions"]
+        return {"positions": int(n), **{name: value / n if n else 0.0 for name, value in sums.items() if name != "positions"}}
+
+    return {
+        "overall": rates({name: sum(values) for name, values in totals.items()}),
+        "phases": {phase: rates({name: values[i] for name, values in totals.items()}) for i, phase in enumerate(PHASES)}
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate a model's move predictions on held-out games")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--data-dir", help="processed dataset (packed or .pt chunks)")
+    source.add_argument("--pgn", help=".pgn or .pgn.zst file, every mainline position is evaluated")
+    parser.add_argument("--model", default="model.pt")
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--shard-mb", type=float, default=16, help="decompressed PGN bytes per task")
+    parser.add_argument("--no-legal", action="store_true", help="skip legal move generation & legal move metrics")
+    parser.add_argument("--report", default="eval_report.json")
+    args = parser.parse_args()
 
-            mask = torch.zeros(4864, device=device)
-            for move in legal_moves:
-                mask[encode_move(move)] = 1
+    legal = not args.no_legal
+    threads = max(1, os.cpu_count() // args.workers)
+    start = time.perf_counter()
+    totals = {}
 
-            policy *= mask
-            policy /= policy.sum()
+    if args.data_dir:
+        chunks = len(open_dataset(args.data_dir).file_sizes)
+        tasks = ((file_idx, evaluate_chunk, file_idx, args.batch_size, legal) for file_idx in range(chunks))
+    else:
+        tasks = ((None, evaluate_games, games, args.batch_size, legal) for _, games in iter_shards(args.pgn, int(args.shard_mb * 1024 * 1024)))
 
-            best_idx = torch.argmax(policy).item()
-            best_move = decode_move(best_idx)
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(args.model, args.device, threads, args.data_dir)) as pool:
+        for _, result in submit_bounded(pool, tasks, 2 * args.workers):
+            merge(totals, result)
+            positions = int(sum(totals.get("positions", [0])))
+            print(f"{positions} positions, {positions / (time.perf_counter() - start):.0f}/s", flush=True)
 
-            print(best_move)
+    elapsed = time.perf_counter() - start
+    report = {
+        "model": args.model,
+        "source": args.data_dir or args.pgn,
+        "elapsed_s": elapsed,
+        "positions_per_s": sum(totals.get("positions", [0])) / elapsed,
+        **(summarize(totals) if totals else {})
+    }
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
 
+    for name, metrics in [("overall", report.get("overall"))] + list(report.get("phases", {}).items()):
+        if metrics:
+            print(f"{name:<11} " + "  ".join(f"{key} {value:.4f}" if isinstance(value, float) else f"{key} {value}" for key, value in metrics.items()))
+    print(f"Evaluated in {elapsed:.1f}s, wrote {args.report}")
 
 if __name__ == "__main__":
     multiprocessing.freeze_support()
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import importlib.util
+import os
+import time
+import chess
+import torch
+import torch.nn as nn
+from engine import load_model
+from dataset import encode_boards
+from policy import best_moves
+from benchmark import sample_fens
+
+def quantize(model: nn.Module) -> nn.Module:
+    # Dynamic quantization stores Linear weights as int8 and quantizes
+    # activations on the fly; the 20M parameter head dominates the model
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+def export_torchscript(model: nn.Module, path: str):
+    example = torch.zeros((1, 13, 8, 8))
+    with torch.no_grad():
+        scripted = torch.jit.trace(model, example)
+    scripted.save(path)
+
+def export_onnx(model: nn.Module, path: str):
+    # The TorchScript-based exporter only needs onnx, the default dynamo one also onnxscript
+    example = torch.zeros((1, 13, 8, 8))
+    torch.onnx.export(
+        model,
+        (example,),
+        path,
+        input_names=["boards"],
+        output_names=["logits"],
+        dynamic_axes={"boards": {0: "batch"}, "logits": {0: "batch"}},
+        dynamo=False
+    )
+
+def mean_latency(model: nn.Module, boards: torch.Tensor, repeats: int = 50) -> float:
+    """
+    Average seconds per single-position forward pass.
+    """
+    with torch.no_grad():
+        model(boards[:1])
+        start = time.perf_counter()
+        for i in range(repeats):
+            model(boards[i % len(boards):i % len(boards) + 1])
+    return (time.perf_counter() - start) / repeats
+
+def parity_check(reference: nn.Module, candidate: nn.Module, positions: int, seed: int) -> dict:
+    """
+    Compares the legal move chosen by both models over randomly played positions.
+    """
+    fens = sample_fens(positions, seed)
+    move_lists = [[move.uci() for move in chess.Board(fen).legal_moves] for fen in fens]
+    boards = encode_boards(fens)
+
+    with torch.no_grad():
+        reference_logits = reference(boards)
+        candidate_logits = candidate(boards)
+
+    reference_moves = best_moves(reference_logits, move_lists)
+    candidate_moves = best_moves(candidate_logits, move_lists)
+    agree = sum(a == b for a, b in zip(reference_moves, candidate_moves))
+
+    return {
+        "positions": positions,
+        "top1_agreement": agree / positions,
+        "max_logit_diff": (reference_logits - candidate_logits).abs().max().item(),
+        "reference_latency_ms": mean_latency(reference, boards) * 1000,
+        "candidate_latency_ms": mean_latency(candidate, boards) * 1000
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Export ChessEngine for serving")
+    parser.add_argument("--model", default="model.pt")
+    parser.add_argument("--output", default="model.int8.ts", help="TorchScript artifact to write")
+    parser.add_argument("--no-quantize", action="store_true", help="export fp32 weights")
+    parser.add_argument("--onnx", metavar="PATH", help="also export an fp32 ONNX model")
+    parser.add_argument("--positions", type=int, default=1000, help="positions used for the parity check")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # onnx is optional, so a missing install is reported before anything is written
+    if args.onnx and importlib.util.find_spec("onnx") is None:
+        parser.error("--onnx needs the onnx package: pip install onnx")
+
+    torch.set_num_threads(1)
+    device = torch.device("cpu")
+    model = load_model(args.model, device)
+
+    exported = model if args.no_quantize else quantize(model)
+    export_torchscript(exported, args.output)
+
+    # Check the artifact as the server will load it
+    candidate = load_model(args.output, device)
+    report = parity_check(model, candidate, args.positions, args.seed)
+
+    print(f"Wrote {args.output} ({os.path.getsize(args.output) / 2**20:.1f} MB, {args.model} is {os.path.getsize(args.model) / 2**20:.1f} MB)")
+    print(f"Top-1 agreement: {report['top1_agreement']:.2%} over {report['positions']} positions (max logit diff {report['max_logit_diff']:.4f})")
+    print(f"Latency per move: {report['reference_latency_ms']:.3f} ms fp32 -> {report['candidate_latency_ms']:.3f} ms exported")
+
+    if args.onnx:
+        export_onnx(model, args.onnx)
+        print(f"Wrote {args.onnx} ({os.path.getsize(args.onnx) / 2**20:.1f} MB)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+import gc
+import os
+import time
+from resources import memory_usage, format_memory
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+# Game sessions (/api/sessions) live in the memory of the worker that created
+# them, so with more than one worker they need sticky routing by session id
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+worker_class = "gthread"
+threads = int(os.environ.get("THREADS", 16))
+
+# Load main.py (and the model) once in the master; forked workers then share
+# the weights copy-on-write instead of each loading their own copy
+preload_app = True
+
+def on_starting(server):
+    server.boot_started = time.perf_counter()
+
+def when_ready(server):
+    elapsed = time.perf_counter() - server.boot_started
+    server.log.info(f"Master ready in {elapsed:.2f}s | {format_memory(memory_usage())}")
+
+def pre_fork(server, worker):
+    # Objects untracked by the GC are never written to by collections, which
+    # keeps the preloaded pages shared after fork
+    gc.freeze()
+
+def post_worker_init(worker):
+    worker.log.info(f"Worker {worker.pid} booted | {format_memory(memory_usage())}")
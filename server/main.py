@@ -1,58 +1,140 @@
-from flask import Flask, request, jsonify
+import time
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_cors import CORS
 # import multiprocessing
-import torch
 import os
-from engine import ChessEngine
-from dataset import encode_move, decode_move, encode_board
-
-torch.set_num_threads(1)
-torch.set_num_interop_threads(1)
+import serving
+from metrics import REQUESTS, ERRORS, REQUEST_SECONDS, STAGE_SECONDS
 
 app = Flask(__name__)
 CORS(app, resources={
     r'/api/*': {
-        'origins': [
-            "http://localhost:5173", 
-            "https://chess-remake-ax6m.vercel.app"
-        ]
+        'origins': serving.ORIGINS
     }
 })
 
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024  # 16 KB
+# Set per request rather than in app.config, which a None request limit falls back to
+MAX_CONTENT_LENGTH = 16 * 1024  # 16 KB
+BULK_MAX_JSON_LENGTH = 8 * 1024 * 1024  # 8 MB, NDJSON bodies are streamed & unbounded
+BULK_DEFAULT_TOP_K = 5
+
+def endpoint() -> str:
+    # The route pattern rather than the raw path keeps label cardinality bounded
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
 
-device = torch.device("mps") if torch.backends.mps.is_available() else torch.device("cpu")
-model = ChessEngine().to(device)
+@app.before_request
+def limit_body():
+    # /api/batch raises or lifts the limit for its own bodies
+    request.max_content_length = MAX_CONTENT_LENGTH
 
-model.load_state_dict(torch.load("model.pt", map_location=device))
-model.eval()
+@app.after_request
+def record_request(response):
+    REQUESTS.inc(endpoint=endpoint(), status=str(response.status_code))
+    REQUEST_SECONDS.observe(time.perf_counter() - g.started, endpoint=endpoint())
+    return response
+
+@app.teardown_request
+def record_error(error):
+    if error is not None:
+        ERRORS.inc(endpoint=endpoint(), type=type(error).__name__)
 
 @app.route('/api/process', methods=["POST"])
 def move():
-    data: dict = request.get_json()
-    fen: str = data.get("fen")
-    legal_moves: list[str] = data.get("moves")
+    with STAGE_SECONDS.time(stage="parse"):
+        data: dict = request.get_json()
+        try:
+            fen, legal_moves = serving.resolve_position(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
-    with torch.no_grad():
-        board_tensor = encode_board(fen).unsqueeze(0).to(device)
-        logits = model(board_tensor)[0]
-        policy = torch.softmax(logits, dim=0)
+    # Optional lookahead, e.g. {"search": {"nodes": 400, "time_ms": 200}}
+    if isinstance(data.get("search"), dict):
+        try:
+            best_move, search_stats = serving.search_move(fen, data["search"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({
+            "move": best_move,
+            "search": search_stats
+        })
 
-        mask = torch.zeros(4864, device=device)
-        for move in legal_moves:
-            mask[encode_move(move)] = 1
+    return jsonify({
+        "move": serving.select_move(fen, legal_moves)
+    })
 
-        policy *= mask
-        policy /= policy.sum()
+def read_lines(stream):
+    # Lines are decoded by serving.parse_position, so bad bytes fail only their own entry
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield line
 
-        best_idx = torch.argmax(policy).item()
-        best_move = decode_move(best_idx)
+@app.route('/api/batch', methods=["POST"])
+def batch():
+    top_k = request.args.get("k", default=BULK_DEFAULT_TOP_K, type=int)
+    if top_k < 1:
+        return jsonify({"error": f"Invalid k: {top_k}"}), 400
 
-        return jsonify({
-            "move": best_move
-        })
+    # NDJSON bodies are consumed line by line, so memory stays flat regardless of input size
+    if request.mimetype == "application/x-ndjson":
+        request.max_content_length = None
+        positions = read_lines(request.stream)
+    else:
+        request.max_content_length = BULK_MAX_JSON_LENGTH
+        try:
+            positions = serving.batch_positions(request.get_json())
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+    return Response(stream_with_context(serving.score_stream(positions, top_k)), mimetype="application/x-ndjson")
+
+@app.route('/api/stats', methods=["GET"])
+def stats():
+    return jsonify(serving.stats())
+
+@app.route('/api/sessions', methods=["POST"])
+def create_session():
+    # The body is optional, a new game starts from the initial position
+    data: dict = request.get_json(silent=True) or {}
+    try:
+        return jsonify(serving.create_session(data)), 201
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/api/sessions/<session_id>/move', methods=["POST"])
+def session_move(session_id):
+    data: dict = request.get_json()
+    try:
+        result = serving.session_move(session_id, data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if result is None:
+        return jsonify({"error": "Unknown or expired session"}), 404
+    return jsonify(result)
+
+@app.route('/api/sessions/<session_id>', methods=["DELETE"])
+def delete_session(session_id):
+    if not serving.sessions.delete(session_id):
+        return jsonify({"error": "Unknown or expired session"}), 404
+    return "", 204
+
+@app.route('/metrics', methods=["GET"])
+def metrics():
+    return Response(serving.metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/debug/profile', methods=["GET"])
+def profile():
+    # e.g. curl 'localhost:5000/debug/profile?seconds=10' | flamegraph.pl > profile.svg
+    if not serving.PROFILER_ENABLED:
+        return jsonify({"error": "Profiler disabled, set PROFILER_ENABLED=1"}), 404
+    seconds = request.args.get("seconds", default=5, type=float)
+    return Response(serving.profile(seconds), mimetype="text/plain")
 
 if __name__ == "__main__":
     # multiprocessing.freeze_support()
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=port)
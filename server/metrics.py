@@ -0,0 +1,131 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable
+
+# Minimal Prometheus text-format metrics, so serving needs no extra dependency
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.const_labels = {}
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{format_labels({**self.const_labels, **labels})} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield "", dict(zip(self.labelnames, key)), value
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (last one is +Inf), sum of observations
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        for key, counts, total in items:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", {**labels, "le": format_value(bound)}, cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, cumulative
+
+class CallbackGauge:
+    """
+    Gauge (or counter, with kind="counter") read from fn at scrape time. fn
+    returns either a number or a dict of {label value tuple: number}.
+    """
+
+    def __init__(self, name: str, help: str, fn: Callable, labelnames: tuple[str, ...] = (), kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = labelnames
+        self.kind = kind
+
+    def samples(self):
+        value = self.fn()
+        if not isinstance(value, dict):
+            yield "", {}, value
+            return
+        for key, item in value.items():
+            yield "", dict(zip(self.labelnames, key)), item
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter("chess_requests_total", "HTTP requests handled", ("endpoint", "status")))
+ERRORS = REGISTRY.register(Counter("chess_errors_total", "Requests that raised an exception", ("endpoint", "type")))
+REQUEST_SECONDS = REGISTRY.register(Histogram("chess_request_seconds", "End-to-end request latency", ("endpoint",)))
+STAGE_SECONDS = REGISTRY.register(Histogram("chess_stage_seconds", "Latency of each serving stage", ("stage",)))
+BATCH_SIZE = REGISTRY.register(Histogram("chess_batch_size", "Positions per forward pass", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)))
+MODEL_REQUESTS = REGISTRY.register(Counter("chess_model_requests_total", "Moves selected by each served model", ("role", "version")))
+MODEL_SECONDS = REGISTRY.register(Histogram("chess_model_seconds", "Move selection latency of each served model", ("role", "version")))
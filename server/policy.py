@@ -0,0 +1,92 @@
+from functools import lru_cache
+import chess
+import torch
+from dataset import UCI_TO_INDEX, NUM_MOVES
+
+@lru_cache(maxsize=100_000)
+def _legal_moves(position: str) -> tuple[str, ...]:
+    return tuple(move.uci() for move in chess.Board(position + " 0 1").legal_moves)
+
+def legal_moves(fen: str) -> list[str]:
+    """
+    Generates the legal moves of a position in UCI notation. Results are cached
+    per position; the move clocks do not affect legality and are ignored.
+    """
+    return list(_legal_moves(" ".join(fen.split()[:4])))
+
+def play_history(fen: str | None, history: list[str]) -> str:
+    """
+    Applies a list of UCI moves to a position (the starting position if fen is
+    None) and returns the resulting FEN. Raises ValueError on illegal moves.
+    """
+    board = chess.Board(fen) if fen else chess.Board()
+    for uci in history:
+        board.push_uci(uci)
+    return board.fen()
+
+def move_indices(move_lists: list[list[str]], device: torch.device | None = None) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Looks up the action index of every move and pads the lists into a (B, L)
+    index tensor. The returned (B, L) bool tensor marks which entries are real
+    moves; column j of row b always corresponds to move_lists[b][j].
+    """
+    width = max((len(moves) for moves in move_lists), default=0)
+    rows = [
+        [UCI_TO_INDEX.get(uci, -1) for uci in moves] + [-1] * (width - len(moves))
+        for moves in move_lists
+    ]
+
+    indices = torch.tensor(rows, dtype=torch.long).reshape(len(move_lists), width)
+    valid = indices >= 0
+    indices.clamp_(min=0)
+    return indices.to(device), valid.to(device)
+
+def legal_mask(move_lists: list[list[str]], device: torch.device | None = None) -> torch.Tensor:
+    """
+    Returns a (B, 4864) bool tensor with the legal moves of each position set,
+    built with a single scatter.
+    """
+    indices, valid = move_indices(move_lists, device)
+
+    # Padding is routed to an extra column which is dropped afterwards
+    indices = indices.masked_fill(~valid, NUM_MOVES)
+    mask = torch.zeros((len(move_lists), NUM_MOVES + 1), dtype=torch.bool, device=device)
+    mask.scatter_(1, indices, True)
+    return mask[:, :NUM_MOVES]
+
+def legal_logits(logits: torch.Tensor, indices: torch.Tensor, valid: torch.Tensor) -> torch.Tensor:
+    """
+    Gathers the logits of the legal moves only, as a (B, L) tensor with -inf in
+    the padding.
+    """
+    return logits.gather(1, indices).masked_fill(~valid, float("-inf"))
+
+def legal_policy(logits: torch.Tensor, indices: torch.Tensor, valid: torch.Tensor) -> torch.Tensor:
+    """
+    Softmax over the legal moves of each position only, which is the same as
+    masking the full policy and renormalizing.
+    """
+    return torch.softmax(legal_logits(logits, indices, valid), dim=1)
+
+def best_moves(logits: torch.Tensor, move_lists: list[list[str]]) -> list[str | None]:
+    """
+    Picks the highest scoring legal move of each position, or None if a position
+    has no (recognized) legal moves.
+    """
+    indices, valid = move_indices(move_lists, logits.device)
+    return pick_moves(logits, move_lists, indices, valid)
+
+def pick_moves(logits: torch.Tensor, move_lists: list[list[str]], indices: torch.Tensor, valid: torch.Tensor) -> list[str | None]:
+    """
+    Same as best_moves, given the output of move_indices.
+    """
+    if indices.shape[1] == 0:
+        return [None] * len(move_lists)
+
+    best = torch.argmax(legal_logits(logits, indices, valid), dim=1).tolist()
+    has_moves = valid.any(dim=1).tolist()
+
+    return [
+        moves[col] if ok else None
+        for moves, col, ok in zip(move_lists, best, has_moves)
+    ]
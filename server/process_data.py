@@ -1,77 +1,383 @@
+import argparse
+import hashlib
 import io
+import json
 import os
+import random
+import re
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
 import zstandard as zstd
 import chess.pgn
-import random
 import torch
-import re
-from dataset import encode_board, encode_move
+from dataset import BOARD_SIZE, BOARDS_SUFFIX, UCI_TO_INDEX, chess_board_squares, save_packed, read_manifest, write_manifest
+from dedup import deduplicate
 
-def stream_pgn_zst(path):
-    with open(path, "rb") as f:
-        dctx = zstd.ZstdDecompressor()
-        with dctx.stream_reader(f) as reader:
-            text_stream = io.TextIOWrapper(reader, encoding="utf-8")
+MIN_PLY = 8
+MAX_PLY = 80
+SAMPLES_PER_GAME = 5
 
-            while True:
-                game = chess.pgn.read_game(text_stream)
-                if game is None:
-                    break
-                yield game
+def open_pgn(path):
+    """
+    Opens a .pgn or .pgn.zst file as a decompressed binary stream.
+    """
+    f = open(path, "rb")
+    if not path.endswith(".zst"):
+        return f
+    reader = zstd.ZstdDecompressor().stream_reader(f, read_across_frames=True, closefd=True)
+    return io.BufferedReader(reader, buffer_size=1 << 20)
 
-def main():
-    MIN_PLY = 8
-    MAX_PLY = 80
-    SAMPLES_PER_GAME = 5
-    DATAPTS_PER_CHUNK = 10000
-    num_chunks = 0
-    num_datapts = 0
-
-    # Device
-    device = torch.device("mps") if torch.backends.mps.is_available() else torch.device("cpu")
-
-    def new_chunk() -> dict:
-        return {"boards": torch.tensor(()).new_zeros((DATAPTS_PER_CHUNK, 13, 8, 8), device=device), "moves": torch.tensor(()).new_zeros(DATAPTS_PER_CHUNK)}
-    
-    data = new_chunk()
-    for f in os.scandir("data/raw"):
-        if not f.is_file() or not re.fullmatch(".*\.pgn\.zst$", f.path):
-            continue
-        games = stream_pgn_zst(f.path)
-        for game in games:
-            moves = list(game.mainline_moves())
-            if len(moves) <= MIN_PLY:
+# Header-first scanning: a game's headers decide whether its movetext is kept
+# at all, and accepted movetext is tokenized straight from bytes
+BLANK_LINE_RE = re.compile(rb"\r?\n[ \t]*\r?\n")
+HEADER_RE = re.compile(rb'^\[(\w+)\s+"(.*)"\]\s*$')
+COMMENT_RE = re.compile(rb"\{[^}]*\}|;[^\n]*")
+SAN_RE = re.compile(rb"(?:[NBRQK]?[a-h]?[1-8]?x?[a-h][1-8](?:=?[NBRQ])?|O-O-O|O-O)[+#]?")
+
+# Lichess speed categories by estimated duration, base + 40 * increment seconds
+TIME_CONTROLS = [(29, "ultrabullet"), (179, "bullet"), (479, "blitz"), (1499, "rapid")]
+
+def time_control_category(value: str) -> str:
+    if value in ("", "-"):
+        return "correspondence"
+    base, _, increment = value.partition("+")
+    try:
+        estimate = int(base) + 40 * int(increment or 0)
+    except ValueError:
+        return "unknown"
+    return next((name for limit, name in TIME_CONTROLS if estimate <= limit), "classical")
+
+class GameFilter:
+    """
+    Accepts or rejects games from their headers alone, so rejected games are
+    skipped as bytes and never parsed. Elo bounds apply to both players; empty
+    sets accept anything. min_ply is checked on the movetext by process_shard.
+    """
+
+    def __init__(self, min_elo: int | None = None, max_elo: int | None = None, time_controls: set[str] = frozenset(),
+                 results: set[str] = frozenset(), terminations: set[str] = frozenset(), min_ply: int = 0):
+        self.min_elo = min_elo
+        self.max_elo = max_elo
+        self.time_controls = set(time_controls)
+        self.results = set(results)
+        self.terminations = set(terminations)
+        self.min_ply = min_ply
+
+    def filters_headers(self) -> bool:
+        return bool(self.min_elo is not None or self.max_elo is not None or self.time_controls or self.results or self.terminations)
+
+    def accepts(self, header_lines: list[bytes]) -> bool:
+        headers = {}
+        for line in header_lines:
+            match = HEADER_RE.match(line)
+            if match:
+                headers[match[1].decode()] = match[2].decode("utf-8", errors="replace")
+
+        if self.min_elo is not None or self.max_elo is not None:
+            for key in ("WhiteElo", "BlackElo"):
+                try:
+                    elo = int(headers.get(key, ""))
+                except ValueError:
+                    return False
+                if self.min_elo is not None and elo < self.min_elo or self.max_elo is not None and elo > self.max_elo:
+                    return False
+        if self.time_controls and time_control_category(headers.get("TimeControl", "")) not in self.time_controls:
+            return False
+        if self.results and headers.get("Result") not in self.results:
+            return False
+        if self.terminations and headers.get("Termination") not in self.terminations:
+            return False
+        return True
+
+def iter_shards(path: str, shard_bytes: int, game_filter: GameFilter | None = None, stats: dict | None = None):
+    """
+    Splits the decompressed PGN stream into consecutive byte ranges of roughly
+    shard_bytes, aligned to game boundaries. Yields (shard_idx, games) where
+    games is a list of raw game texts.
+
+    Games rejected by game_filter's header checks are dropped as soon as their
+    headers end. Scan counts & time spent outside of yields are added to stats.
+    """
+    if game_filter is not None and not game_filter.filters_headers():
+        game_filter = None
+    if stats is None:
+        stats = {}
+    for key in ("games", "rejected_headers", "scan_s"):
+        stats.setdefault(key, 0)
+
+    shard_idx = 0
+    games = []
+    game = []
+    size = 0
+    in_movetext = False
+    keep = True
+    start = time.perf_counter()
+
+    with open_pgn(path) as stream:
+        for line in stream:
+            # A header after movetext starts a new game
+            if line.startswith(b"[") and in_movetext:
+                if keep:
+                    games.append(b"".join(game))
+                game = []
+                in_movetext = False
+                keep = True
+
+                if size >= shard_bytes:
+                    stats["scan_s"] += time.perf_counter() - start
+                    yield shard_idx, games
+                    start = time.perf_counter()
+                    shard_idx += 1
+                    games = []
+                    size = 0
+            elif not in_movetext and not line.startswith(b"[") and line.strip():
+                # The headers are complete, decide before keeping any movetext
+                in_movetext = True
+                stats["games"] += 1
+                if game_filter is not None and not game_filter.accepts(game):
+                    keep = False
+                    stats["rejected_headers"] += 1
+                    size -= sum(len(header) for header in game)
+                    game = []
+
+            if keep:
+                game.append(line)
+                size += len(line)
+
+    if game and keep:
+        games.append(b"".join(game))
+    stats["scan_s"] += time.perf_counter() - start
+    if games:
+        yield shard_idx, games
+
+def scan_movetext(text: bytes) -> list[bytes] | None:
+    """
+    Returns the SAN tokens of a game's mainline, or None if the game needs the
+    full parser (a custom start position or variations).
+    """
+    parts = BLANK_LINE_RE.split(text, maxsplit=1)
+    headers, movetext = parts if len(parts) == 2 else (b"", parts[0])
+    if b'[FEN "' in headers or b"(" in movetext:
+        return None
+    return SAN_RE.findall(COMMENT_RE.sub(b" ", movetext))
+
+def pgn_sources(raw_dir: str) -> list[str]:
+    """
+    The .pgn and .pgn.zst files of a directory, in a stable order.
+    """
+    return sorted(
+        f.path for f in os.scandir(raw_dir)
+        if f.is_file() and re.fullmatch(r".*\.pgn(\.zst)?$", f.path)
+    )
+
+def submit_bounded(pool: Executor, tasks, max_pending: int):
+    """
+    Submits (key, fn, *args) tasks from an iterable to the pool and yields
+    (key, result) as they complete. Tasks are only drawn while fewer than
+    max_pending are in flight, so reading never races ahead of the workers.
+    """
+    pending = {}
+    for key, fn, *args in tasks:
+        while len(pending) >= max_pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+        pending[pool.submit(fn, *args)] = key
+
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield pending.pop(future), future.result()
+
+def shard_seed(seed: int, source: str, shard_idx: int) -> int:
+    # Stable across runs & processes, unlike hash()
+    digest = hashlib.sha256(f"{seed}:{source}:{shard_idx}".encode()).digest()
+    return int.from_bytes(digest[:8], "little")
+
+def process_shard(games: list[bytes], out_path: str, seed: int, packed: bool = True, min_ply: int = 0) -> dict:
+    """
+    Parses, samples & encodes the games of one shard and writes them as a single
+    chunk, packed or as a torch.save file. Runs in a worker process; returns the
+    number of samples written with per-stage counts & timings.
+
+    Plies are counted from the movetext tokens before anything is parsed, so
+    short games are rejected unparsed and accepted ones are only parsed up to
+    their last sampled ply.
+    """
+    rng = random.Random(seed)
+    squares = []
+    moves = []
+    stats = {"games": len(games), "rejected_ply": 0, "errors": 0}
+    start = time.perf_counter()
+
+    for text in games:
+        game_moves = scan_movetext(text)
+        board = chess.Board()
+        if game_moves is None:
+            game = chess.pgn.read_game(io.StringIO(text.decode("utf-8", errors="replace")))
+            if game is None:
+                stats["errors"] += 1
                 continue
+            board = game.board()
+            game_moves = list(game.mainline_moves())
+
+        if len(game_moves) <= MIN_PLY or len(game_moves) < min_ply:
+            stats["rejected_ply"] += 1
+            continue
 
-            # Store FEN,move pairs for whole game
-            pairs: list[(str, int)] = []
-            board = chess.Board()
-            for move in moves:
-                encoded_move = encode_move(move.uci())
-                pairs.append((board.fen(), encoded_move))
+        candidate_indices = range(MIN_PLY, min(len(game_moves) - 1, MAX_PLY))
+        sampled = set(rng.sample(
+            candidate_indices,
+            k=min(SAMPLES_PER_GAME, len(candidate_indices))
+        ))
+
+        # Replay up to the last sampled ply, encoding straight from the board
+        last = max(sampled, default=-1)
+        try:
+            for ply, move in enumerate(game_moves[:last + 1]):
+                if isinstance(move, bytes):
+                    move = board.parse_san(move.decode())
+                if ply in sampled:
+                    move_idx = UCI_TO_INDEX.get(move.uci())
+                    if move_idx is not None:
+                        squares.append(chess_board_squares(board))
+                        moves.append(move_idx)
                 board.push(move)
+        except ValueError:
+            # Samples taken before the bad move are still valid positions
+            stats["errors"] += 1
+
+    stats["samples"] = len(moves)
+    parsed = time.perf_counter()
+    stats["parse_s"] = parsed - start
+
+    boards = np.zeros((len(squares), BOARD_SIZE), dtype=np.uint8 if packed else np.float32)
+    for row, row_squares in enumerate(squares):
+        boards[row, row_squares] = 1
+
+    if packed:
+        save_packed(out_path, boards, np.array(moves, dtype=np.int16))
+        stats["write_s"] = time.perf_counter() - parsed
+        return stats
+
+    data = {
+        "boards": torch.from_numpy(boards).view(-1, 13, 8, 8),
+        "moves": torch.tensor(moves, dtype=torch.long)
+    }
+
+    # Written under a temporary name so a crash never leaves a partial chunk behind
+    tmp_path = out_path + ".tmp"
+    torch.save(data, tmp_path)
+    os.replace(tmp_path, out_path)
+    stats["write_s"] = time.perf_counter() - parsed
+    return stats
+
+def convert_chunks(src_dir: str, dst_dir: str):
+    """
+    Repacks torch.save chunks into the packed format, one shard per chunk.
+    """
+    manifest = read_manifest(dst_dir)
+    for fname in sorted(f for f in os.listdir(src_dir) if f.endswith(".pt")):
+        name = fname[:-len(".pt")]
+        out_path = os.path.join(dst_dir, name)
+        if os.path.exists(out_path + BOARDS_SUFFIX):
+            continue
+
+        data = torch.load(os.path.join(src_dir, fname), map_location="cpu")
+        save_packed(out_path, data["boards"].numpy() != 0, data["moves"].numpy().astype(np.int16))
+        manifest[name] = data["moves"].shape[0]
+        write_manifest(dst_dir, manifest)
+        print(f"Packed {fname} ({data['moves'].shape[0]} samples)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert Lichess PGN dumps into training chunks")
+    parser.add_argument("--raw-dir", default="data/raw")
+    parser.add_argument("--out-dir", default="data/processed")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--shard-mb", type=float, default=64, help="decompressed PGN bytes per shard")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", choices=["packed", "pt"], default="packed", help="bit-packed memory-mapped shards or torch.save chunks")
+    parser.add_argument("--convert-pt", metavar="DIR", help="repack existing torch.save chunks from DIR into --out-dir and exit")
+    parser.add_argument("--dedup-cap", type=int, default=0, help="afterwards keep at most this many samples per position in --dedup-dir, 0 disables")
+    parser.add_argument("--dedup-with-move", action="store_true", help="cap samples per position & move instead")
+    parser.add_argument("--dedup-dir", default="data/dedup")
+    parser.add_argument("--min-elo", type=int, help="skip games where either player is rated lower")
+    parser.add_argument("--max-elo", type=int, help="skip games where either player is rated higher")
+    parser.add_argument("--time-controls", default="", help="comma-separated speeds to keep: ultrabullet, bullet, blitz, rapid, classical, correspondence")
+    parser.add_argument("--results", default="", help="comma-separated results to keep, e.g. 1-0,0-1,1/2-1/2")
+    parser.add_argument("--terminations", default="", help='comma-separated Termination headers to keep, e.g. "Normal,Time forfeit"')
+    parser.add_argument("--min-ply", type=int, default=0, help="skip games with fewer plies")
+    args = parser.parse_args()
+
+    if args.dedup_cap and args.format != "packed":
+        parser.error("--dedup-cap needs --format packed")
+
+    if args.convert_pt:
+        os.makedirs(args.out_dir, exist_ok=True)
+        convert_chunks(args.convert_pt, args.out_dir)
+        return
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    shard_bytes = int(args.shard_mb * 1024 * 1024)
+
+    def split(value):
+        return {item.strip() for item in value.split(",") if item.strip()}
+    game_filter = GameFilter(args.min_elo, args.max_elo, split(args.time_controls), split(args.results), split(args.terminations), args.min_ply)
+
+    start = time.perf_counter()
+    skipped = 0
+    written = 0
+    samples = 0
+    scan_stats = {}
+    shard_stats = {"games": 0, "rejected_ply": 0, "errors": 0, "parse_s": 0.0, "write_s": 0.0}
+
+    # Sample counts per chunk, so datasets never have to open chunks to size them
+    manifest = read_manifest(args.out_dir)
+
+    def tasks():
+        nonlocal skipped
+        for path in pgn_sources(args.raw_dir):
+            source = os.path.basename(path).split(".")[0]
+            for shard_idx, games in iter_shards(path, shard_bytes, game_filter, scan_stats):
+                name = f"{source}_{shard_idx:05d}" + (".pt" if args.format == "pt" else "")
+                out_path = os.path.join(args.out_dir, name)
 
-            candidate_indices = range(MIN_PLY, min(len(moves) - 1, MAX_PLY))
+                # Shards that finished before a crash are not reprocessed
+                if os.path.exists(out_path + BOARDS_SUFFIX if args.format == "packed" else out_path):
+                    skipped += 1
+                    continue
 
-            sampled = random.sample(
-                candidate_indices,
-                k=min(SAMPLES_PER_GAME, len(candidate_indices))
-            )
+                yield name, process_shard, games, out_path, shard_seed(args.seed, source, shard_idx), args.format == "packed", args.min_ply
 
-            for idx in sampled:
-                fen, encoded_move = pairs[idx]
-                board_tensor = encode_board(fen).to(device)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for name, stats in submit_bounded(pool, tasks(), 2 * args.workers):
+            manifest[name] = stats["samples"]
+            samples += stats["samples"]
+            written += 1
+            for key in shard_stats:
+                shard_stats[key] += stats[key]
+            write_manifest(args.out_dir, manifest)
 
-                data["boards"][num_datapts] = board_tensor
-                data["moves"][num_datapts] = encoded_move
+    elapsed = time.perf_counter() - start
+    print(f"Wrote {written} shards ({samples} samples) in {elapsed:.1f}s, skipped {skipped} completed shards")
 
-                num_datapts += 1
+    # Games/sec per stage; parsing & writing run in parallel, so they are per worker
+    def rate(games, seconds):
+        return f"{games / seconds:.0f} games/s" if seconds else "n/a"
+    parsed = shard_stats["games"] - shard_stats["rejected_ply"] - shard_stats["errors"]
+    print(f"  scan : {scan_stats.get('games', 0)} games, {scan_stats.get('rejected_headers', 0)} rejected by headers, "
+          f"{rate(scan_stats.get('games', 0), scan_stats.get('scan_s', 0))}")
+    print(f"  parse: {shard_stats['games']} games, {shard_stats['rejected_ply']} too short, {shard_stats['errors']} unparsable, "
+          f"{rate(shard_stats['games'], shard_stats['parse_s'])} per worker")
+    print(f"  write: {parsed} games, {rate(parsed, shard_stats['write_s'])} per worker")
 
-                if num_datapts == DATAPTS_PER_CHUNK:
-                    torch.save(data, f"data/processed/chunk_{num_chunks:03d}.pt")
-                    num_chunks += 1
-                    num_datapts = 0
-                    data = new_chunk()
+    # Repeated positions (mostly openings) are capped across all shards at once
+    if args.dedup_cap:
+        stats = deduplicate(args.out_dir, args.dedup_dir, args.dedup_cap, args.dedup_with_move)
+        with open(os.path.join(args.dedup_dir, "dedup_stats.json"), "w") as f:
+            json.dump(stats, f, indent=2)
+        print(f"Deduplicated into {args.dedup_dir}: kept {stats['kept']} of {stats['samples']} samples ({stats['dropped_fraction']:.1%} dropped)")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,31 @@
+import sys
+import threading
+import time
+from collections import Counter
+
+def sample_stacks(seconds: float, interval_ms: float = 5.0) -> str:
+    """
+    Samples the Python stacks of every thread in the process for the given
+    duration and returns them in collapsed format ("frame;frame;frame count"
+    per line), which flamegraph.pl and speedscope render as a flamegraph.
+    """
+    own = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = Counter()
+
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            frames.append(names.get(ident, str(ident)))
+            stacks[";".join(reversed(frames))] += 1
+        time.sleep(interval_ms / 1000)
+
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
@@ -0,0 +1,223 @@
+import os
+import random
+import threading
+import time
+import traceback
+import zlib
+from typing import Callable
+import chess
+import torch
+from engine import load_model, model_version
+from dataset import encode_boards
+from batcher import InferenceBatcher
+from search import PolicyEvaluator
+
+# Positions run through a freshly loaded model before it takes traffic
+WARMUP_FENS = [
+    chess.STARTING_FEN,
+    "r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3",
+    "r2q1rk1/pp2bppp/2n1pn2/3p4/3P4/2NBPN2/PP3PPP/R2Q1RK1 w - - 0 10",
+    "8/5pk1/6p1/8/3R4/6P1/5PKP/r7 b - - 3 40"
+]
+
+def model_device(path: str) -> torch.device:
+    # Quantized artifacts only have CPU kernels
+    return torch.device("mps") if torch.backends.mps.is_available() and not path.endswith(".ts") else torch.device("cpu")
+
+def file_signature(path: str) -> tuple[int, int] | None:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+class ServedModel:
+    """
+    A loaded model with the batcher & search evaluator serving it, and the
+    request counters used to compare it with the other model.
+    """
+
+    def __init__(self, role: str, path: str, version: str, model: torch.nn.Module, device: torch.device,
+                 batcher_options: dict, table_size: int):
+        self.role = role
+        self.path = path
+        self.version = version
+        self.model = model
+        self.device = device
+        self.batcher = InferenceBatcher(model, device, **batcher_options)
+        self.evaluator = PolicyEvaluator(model, device, table_size=table_size)
+
+        self.loaded_at = time.time()
+        self.load_s = 0.0
+        self.warmup_s = 0.0
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.latency_s = 0.0
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.requests += 1
+            self.latency_s += seconds
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "version": self.version,
+            "device": str(self.device),
+            "loaded_at": self.loaded_at,
+            "load_s": self.load_s,
+            "warmup_s": self.warmup_s,
+            "requests": self.requests,
+            "mean_latency_ms": self.latency_s / self.requests * 1000 if self.requests else 0.0
+        }
+
+class ModelRegistry:
+    """
+    Serves a primary model and optionally a candidate that receives
+    candidate_percent of the requests. Both files are polled every
+    poll_interval_s; a changed file is loaded & warmed up in a background thread
+    and swapped in atomically, while the model it replaces finishes the
+    positions already queued for it. A file that fails to load leaves the
+    current model in place.
+    """
+
+    def __init__(self, path: str, candidate_path: str | None = None, candidate_percent: float = 0.0,
+                 poll_interval_s: float = 5.0, warmup_batches: int = 3, mmap: bool = False,
+                 batcher_options: dict | None = None, table_size: int = 200_000,
+                 on_swap: Callable[[str, ServedModel, ServedModel], None] | None = None):
+        if not 0 <= candidate_percent <= 100:
+            raise ValueError(f"Invalid candidate percentage: {candidate_percent}")
+
+        self.paths = {"primary": path, "candidate": candidate_path}
+        self.candidate_percent = candidate_percent
+        self.poll_interval = poll_interval_s
+        self.warmup_batches = warmup_batches
+        self.mmap = mmap
+        self.batcher_options = batcher_options or {}
+        self.table_size = table_size
+        self.on_swap = on_swap
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._signatures = {role: file_signature(path) for role, path in self.paths.items() if path}
+
+        self.reloads = 0
+        self.failures = 0
+        self.last_error = None
+
+        self.primary = self._load("primary", path)
+        self.candidate = self._load("candidate", candidate_path) if candidate_path else None
+
+    def _load(self, role: str, path: str, version: str | None = None) -> ServedModel:
+        start = time.perf_counter()
+        device = model_device(path)
+        model = load_model(path, device, mmap=self.mmap)
+        served = ServedModel(role, path, version or model_version(path), model, device, self.batcher_options, self.table_size)
+        loaded = time.perf_counter()
+        self.warm_up(served)
+        served.load_s = loaded - start
+        served.warmup_s = time.perf_counter() - loaded
+        return served
+
+    def warm_up(self, served: ServedModel):
+        """
+        Runs a few forward passes at batch size 1 and at the batcher's largest
+        batch, so the first real requests do not pay for lazy initialization.
+        """
+        size = served.batcher.max_batch_size
+        boards = encode_boards((WARMUP_FENS * (size // len(WARMUP_FENS) + 1))[:size]).to(served.device)
+        with torch.no_grad():
+            for _ in range(self.warmup_batches):
+                for batch_size in sorted({1, size}):
+                    served.model(boards[:batch_size])
+
+    def _ensure_started(self):
+        # The watcher is started lazily, and restarted after a fork (e.g.
+        # gunicorn --preload), since threads do not survive fork()
+        if self.poll_interval <= 0 or self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            worker = threading.Thread(target=self._watch, name="model-watcher", daemon=True)
+            worker.start()
+            self._pid = os.getpid()
+
+    def _watch(self):
+        changed = {}
+        while True:
+            time.sleep(self.poll_interval)
+            for role, path in self.paths.items():
+                if path is None:
+                    continue
+                signature = file_signature(path)
+                if signature is None or signature == self._signatures[role]:
+                    changed.pop(role, None)
+                    continue
+
+                # A file still being written keeps changing, so wait until it is stable for a whole interval
+                if changed.get(role) != signature:
+                    changed[role] = signature
+                    continue
+                del changed[role]
+                self._signatures[role] = signature
+                self.reload(role)
+
+    def reload(self, role: str) -> bool:
+        """
+        Loads the file of a role and swaps it in, unless its content is what is
+        already served. Returns whether the model was swapped.
+        """
+        path = self.paths[role]
+        current = getattr(self, role)
+        try:
+            version = model_version(path)
+            if current is not None and current.version == version:
+                return False
+            served = self._load(role, path, version)
+        except Exception as e:
+            self.failures += 1
+            self.last_error = f"{path}: {e}"
+            print(f"Keeping the current {role} model, loading {path} failed:\n{traceback.format_exc()}", flush=True)
+            return False
+
+        # Requests read the attribute once, so each one is served entirely by the old or the new model
+        setattr(self, role, served)
+        self.reloads += 1
+        if self.on_swap is not None:
+            self.on_swap(role, current, served)
+        if current is not None:
+            current.batcher.close()
+
+        print(f"Swapped in {role} model {path} ({version}), loaded in {served.load_s:.2f}s & warmed up in {served.warmup_s:.2f}s", flush=True)
+        return True
+
+    def route(self, key: str | None = None) -> ServedModel:
+        """
+        Picks the model for a request. Requests with a key (e.g. a game
+        session) always get the same model, others are split at random.
+        """
+        self._ensure_started()
+        candidate = self.candidate
+        if candidate is None or self.candidate_percent <= 0:
+            return self.primary
+
+        draw = zlib.crc32(key.encode()) % 10_000 / 100 if key is not None else random.random() * 100
+        return candidate if draw < self.candidate_percent else self.primary
+
+    def models(self) -> list[ServedModel]:
+        return [served for served in (self.primary, self.candidate) if served is not None]
+
+    def stats(self) -> dict:
+        return {
+            "primary": self.primary.stats(),
+            "candidate": self.candidate.stats() if self.candidate is not None else None,
+            "candidate_percent": self.candidate_percent,
+            "poll_interval_s": self.poll_interval,
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "last_error": self.last_error
+        }
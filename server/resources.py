@@ -0,0 +1,31 @@
+import resource
+import sys
+
+def memory_usage() -> dict[str, int]:
+    """
+    Memory of the current process in bytes. On Linux RSS is split into pages
+    shared with other processes (e.g. forked workers) and private pages; PSS
+    charges each shared page proportionally to the processes mapping it.
+    """
+    try:
+        fields = {}
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                parts = rest.split()
+                if len(parts) == 2 and parts[1] == "kB":
+                    fields[key] = int(parts[0]) * 1024
+
+        return {
+            "rss": fields["Rss"],
+            "pss": fields["Pss"],
+            "shared": fields["Shared_Clean"] + fields["Shared_Dirty"],
+            "private": fields["Private_Clean"] + fields["Private_Dirty"]
+        }
+    except (OSError, KeyError):
+        # ru_maxrss is in kilobytes on Linux but bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {"max_rss": max_rss if sys.platform == "darwin" else max_rss * 1024}
+
+def format_memory(usage: dict[str, int]) -> str:
+    return ", ".join(f"{key} {value / 2**20:.1f} MB" for key, value in usage.items())
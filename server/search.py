@@ -0,0 +1,219 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+import chess
+import chess.polyglot
+import numpy as np
+import torch
+from dataset import BOARD_SIZE, chess_board_squares
+from policy import move_indices, legal_policy
+
+PIECE_VALUES = {chess.PAWN: 1, chess.KNIGHT: 3, chess.BISHOP: 3, chess.ROOK: 5, chess.QUEEN: 9}
+
+def material_value(board: chess.Board) -> float:
+    """
+    Static evaluation in [-1, 1] from the side to move's perspective. The
+    network only has a policy head, so leaf values come from material.
+    """
+    balance = 0
+    for piece_type, value in PIECE_VALUES.items():
+        balance += value * (len(board.pieces(piece_type, chess.WHITE)) - len(board.pieces(piece_type, chess.BLACK)))
+    if board.turn == chess.BLACK:
+        balance = -balance
+    return math.tanh(balance / 10)
+
+class PolicyEvaluator:
+    """
+    Evaluates batches of positions into (legal moves, priors) with one forward
+    pass. Results are kept in a bounded transposition table keyed by Zobrist
+    hash, shared across searches.
+    """
+
+    def __init__(self, model: torch.nn.Module, device: torch.device, table_size: int = 200_000):
+        self.model = model
+        self.device = device
+        self.table_size = table_size
+
+        self._table = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, key: int):
+        with self._lock:
+            entry = self._table.get(key)
+            if entry is not None:
+                self._table.move_to_end(key)
+            return entry
+
+    def evaluate(self, keys: list[int], boards: list[chess.Board]) -> list[tuple[list[chess.Move], list[float]]]:
+        move_lists = [list(board.legal_moves) for board in boards]
+
+        encoded = np.zeros((len(boards), BOARD_SIZE), dtype=np.float32)
+        for row, board in enumerate(boards):
+            encoded[row, chess_board_squares(board)] = 1
+
+        with torch.no_grad():
+            logits = self.model(torch.from_numpy(encoded).view(-1, 13, 8, 8).to(self.device))
+            indices, valid = move_indices([[move.uci() for move in moves] for moves in move_lists], self.device)
+            priors = legal_policy(logits, indices, valid).tolist() if indices.shape[1] else [[] for _ in boards]
+
+        results = [(moves, row[:len(moves)]) for moves, row in zip(move_lists, priors)]
+
+        with self._lock:
+            for key, result in zip(keys, results):
+                self._table[key] = result
+                self._table.move_to_end(key)
+            while len(self._table) > self.table_size:
+                self._table.popitem(last=False)
+
+        return results
+
+class Node:
+    __slots__ = ("moves", "priors", "children", "visits", "value_sum", "terminal")
+
+    def __init__(self):
+        self.moves = None # None until expanded
+        self.priors = None
+        self.children = {}
+        self.visits = 0
+        self.value_sum = 0.0 # from the perspective of the player who moved into this node
+        self.terminal = None
+
+    def expand(self, moves: list[chess.Move], priors: list[float]):
+        # NaN priors (no recognized legal move) fall back to uniform
+        if moves and not all(p == p for p in priors):
+            priors = [1 / len(moves)] * len(moves)
+        self.moves = moves
+        self.priors = priors
+
+def terminal_value(board: chess.Board) -> float | None:
+    # Value for the side to move, or None if the game goes on
+    if board.is_checkmate():
+        return -1.0
+    if board.is_stalemate() or board.is_insufficient_material() or board.can_claim_fifty_moves() or board.is_repetition(3):
+        return 0.0
+    return None
+
+def search(root_board: chess.Board, evaluator: PolicyEvaluator, max_nodes: int = 400, time_ms: float | None = None,
+           batch_size: int = 16, c_puct: float = 1.5, virtual_loss: int = 1) -> tuple[chess.Move | None, dict]:
+    """
+    PUCT Monte Carlo tree search using the network's policy as move priors.
+    Leaves are collected batch_size at a time with virtual loss and evaluated in
+    one forward pass. Stops after max_nodes simulations or time_ms, whichever
+    comes first; time_ms=None means no time limit. Returns the most visited
+    move, or the highest prior one without simulations, and search statistics.
+    """
+    start = time.perf_counter()
+    deadline = start + time_ms / 1000 if time_ms is not None else None
+    board = root_board.copy()
+
+    root = Node()
+    root_key = chess.polyglot.zobrist_hash(board)
+    entry = evaluator.lookup(root_key) or evaluator.evaluate([root_key], [board.copy(stack=False)])[0]
+    root.expand(*entry)
+
+    stats = {"nodes": 0, "batches": 0, "evaluated": 0, "tt_hits": 0, "max_depth": 0}
+    if len(root.moves) <= 1:
+        best = root.moves[0] if root.moves else None
+        return best, finish_stats(stats, start)
+
+    def select():
+        # Walks down by PUCT, applying virtual loss along the path
+        node, path = root, [root]
+        while node.moves is not None and node.terminal is None and node.moves:
+            sqrt_visits = math.sqrt(node.visits + 1)
+            best_score, best_move = -math.inf, None
+            for move, prior in zip(node.moves, node.priors):
+                child = node.children.get(move)
+                if child is None or child.visits == 0:
+                    score = c_puct * prior * sqrt_visits
+                else:
+                    score = child.value_sum / child.visits + c_puct * prior * sqrt_visits / (1 + child.visits)
+                if score > best_score:
+                    best_score, best_move = score, move
+
+            child = node.children.get(best_move)
+            if child is None:
+                child = node.children[best_move] = Node()
+            board.push(best_move)
+            path.append(child)
+            node = child
+
+        for visited in path:
+            visited.visits += virtual_loss
+            visited.value_sum -= virtual_loss
+        return path
+
+    def revert(path):
+        for visited in path:
+            visited.visits -= virtual_loss
+            visited.value_sum += virtual_loss
+
+    def backup(path, value):
+        # value is from the perspective of the side to move at the leaf
+        for visited in reversed(path):
+            visited.visits += 1 - virtual_loss
+            visited.value_sum += virtual_loss - value
+            value = -value
+
+    while stats["nodes"] < max_nodes and (deadline is None or time.perf_counter() < deadline):
+        pending = []
+        pending_nodes = set()
+
+        for _ in range(min(batch_size, max_nodes - stats["nodes"])):
+            path = select()
+            leaf = path[-1]
+            depth = len(path) - 1
+            stats["max_depth"] = max(stats["max_depth"], depth)
+            stats["nodes"] += 1
+
+            if leaf.terminal is None and leaf.moves is None:
+                leaf.terminal = terminal_value(board)
+
+            if leaf.terminal is not None:
+                backup(path, leaf.terminal)
+            elif leaf.moves is not None and not leaf.moves:
+                backup(path, 0.0)
+            elif id(leaf) in pending_nodes:
+                # Already waiting on this leaf; undo and evaluate the batch
+                revert(path)
+                stats["nodes"] -= 1
+                for _ in range(depth):
+                    board.pop()
+                break
+            else:
+                key = chess.polyglot.zobrist_hash(board)
+                entry = evaluator.lookup(key)
+                if entry is not None:
+                    stats["tt_hits"] += 1
+                    leaf.expand(*entry)
+                    backup(path, material_value(board))
+                else:
+                    pending.append((path, key, board.copy(stack=False), material_value(board)))
+                    pending_nodes.add(id(leaf))
+
+            for _ in range(depth):
+                board.pop()
+
+        if pending:
+            results = evaluator.evaluate([key for _, key, _, _ in pending], [leaf_board for _, _, leaf_board, _ in pending])
+            for (path, _, _, value), entry in zip(pending, results):
+                path[-1].expand(*entry)
+                backup(path, value)
+            stats["batches"] += 1
+            stats["evaluated"] += len(pending)
+
+    # Most visited, with ties (e.g. no simulation within the budget) going to the highest prior
+    def rank(item):
+        move, prior = item
+        child = root.children.get(move)
+        return child.visits if child is not None else 0, prior
+    best = max(zip(root.moves, root.priors), key=rank)[0]
+    return best, finish_stats(stats, start)
+
+def finish_stats(stats: dict, start: float) -> dict:
+    elapsed = time.perf_counter() - start
+    stats["time_ms"] = elapsed * 1000
+    stats["nodes_per_s"] = stats["nodes"] / elapsed if elapsed > 0 else 0.0
+    stats["mean_batch_size"] = stats["evaluated"] / stats["batches"] if stats["batches"] else 0.0
+    return stats
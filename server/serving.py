@@ -0,0 +1,387 @@
+import time
+STARTED = time.perf_counter()
+
+import torch
+import os
+import json
+import chess
+from itertools import islice
+from resources import memory_usage, format_memory
+from dataset import board_squares, encode_board, encode_boards
+from registry import ModelRegistry, ServedModel
+from cache import PositionCache, position_key
+from policy import move_indices, legal_policy, best_moves, play_history
+from policy import legal_moves as generate_legal_moves
+from search import search
+from book import OpeningBook
+from sessions import SessionStore, GameSession
+from metrics import REGISTRY, STAGE_SECONDS, MODEL_REQUESTS, MODEL_SECONDS, CallbackGauge
+from profiler import sample_stacks
+
+# Model state & inference shared by the WSGI (main.py) and ASGI (asgi.py) apps
+
+torch.set_num_threads(1)
+torch.set_num_interop_threads(1)
+
+ORIGINS = [
+    "http://localhost:5173",
+    "https://chess-remake-ax6m.vercel.app"
+]
+
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", 256))
+
+# Upper bounds on the budget a single request may ask the search for
+SEARCH_MAX_NODES = int(os.environ.get("SEARCH_MAX_NODES", 2000))
+SEARCH_MAX_TIME_MS = float(os.environ.get("SEARCH_MAX_TIME_MS", 1000))
+
+# On-demand sampling profiler, off by default since each profile holds a request thread for its duration
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED") == "1"
+PROFILE_MAX_SECONDS = 60
+
+# Either a state dict or an exported TorchScript artifact such as model.int8.ts
+MODEL_PATH = os.environ.get("MODEL_PATH", "model.pt")
+
+# Optional second model receiving CANDIDATE_PERCENT of the requests, for A/B comparison
+CANDIDATE_MODEL_PATH = os.environ.get("CANDIDATE_MODEL_PATH") or None
+
+# Repeated positions (mostly openings) skip the model entirely; entries are
+# keyed by model version, so those of a replaced model simply age out
+cache = PositionCache(max_size=int(os.environ.get("CACHE_SIZE", 100_000)))
+
+# With gunicorn --preload the initial models are loaded once in the master and
+# workers share the weights copy-on-write; MODEL_MMAP=1 also shares them between
+# separate processes. Each model gets its own batcher, which evaluates positions
+# from concurrent requests together in one forward pass.
+imported = time.perf_counter()
+registry = ModelRegistry(
+    MODEL_PATH,
+    candidate_path=CANDIDATE_MODEL_PATH,
+    candidate_percent=float(os.environ.get("CANDIDATE_PERCENT", 0)),
+    poll_interval_s=float(os.environ.get("MODEL_POLL_INTERVAL_S", 5)),
+    warmup_batches=int(os.environ.get("MODEL_WARMUP_BATCHES", 3)),
+    mmap=os.environ.get("MODEL_MMAP") == "1",
+    batcher_options={
+        "max_batch_size": int(os.environ.get("BATCH_MAX_SIZE", 32)),
+        "max_wait_ms": float(os.environ.get("BATCH_MAX_WAIT_MS", 2))
+    },
+    # Search priors are shared across requests through each evaluator's transposition table
+    table_size=int(os.environ.get("SEARCH_TABLE_SIZE", 200_000)),
+    on_swap=lambda role, old, new: warm_cache() if role == "primary" else None
+)
+loaded = time.perf_counter()
+
+def choose_moves(fens: list[str], move_lists: list[list[str]]) -> list[str | None]:
+    served = registry.primary
+    with torch.no_grad():
+        logits = served.model(encode_boards(fens).to(served.device))
+        return best_moves(logits, move_lists)
+
+def cache_key(version: str, fen: str, legal_moves: list[str]) -> tuple:
+    return version, *position_key(fen, legal_moves)
+
+def warm_cache():
+    # The openings are evaluated by the primary, again whenever it is replaced
+    if os.environ.get("OPENINGS_FILE"):
+        version = registry.primary.version
+        cache.warm(os.environ["OPENINGS_FILE"], choose_moves, key=lambda fen, legal_moves: cache_key(version, fen, legal_moves))
+
+warm_cache()
+
+# Precomputed moves for common openings (see book.py), looked up before the
+# cache, only for the model the book was built from
+book = OpeningBook(os.environ["BOOK_PATH"]) if os.environ.get("BOOK_PATH") else None
+if book is not None and book.meta["model_version"] not in [served.version for served in registry.models()]:
+    print(f"{book.path} was built from another model ({book.meta['model']}), it is only used once that model is served", flush=True)
+
+# Games played move by move against the engine, see create_session()
+sessions = SessionStore(
+    max_sessions=int(os.environ.get("SESSION_MAX", 10_000)),
+    ttl_s=float(os.environ.get("SESSION_TTL_S", 1800))
+)
+
+# Served versions change on reload, so they are labels of the per-model metrics & chess_model_info
+REGISTRY.const_labels = {"model": os.path.basename(MODEL_PATH)}
+REGISTRY.register(CallbackGauge("chess_model_info", "Models being served", lambda: {
+    (served.role, served.version, os.path.basename(served.path)): 1 for served in registry.models()
+}, labelnames=("role", "version", "file")))
+REGISTRY.register(CallbackGauge("chess_model_reloads_total", "Model reloads by outcome", lambda: {
+    ("swapped",): registry.reloads,
+    ("failed",): registry.failures
+}, labelnames=("result",), kind="counter"))
+REGISTRY.register(CallbackGauge("chess_book_lookups_total", "Opening book lookups", lambda: {
+    ("hit",): book.hits if book else 0,
+    ("miss",): book.misses if book else 0
+}, labelnames=("result",), kind="counter"))
+REGISTRY.register(CallbackGauge("chess_sessions", "Active game sessions", lambda: sessions.stats()["active"]))
+REGISTRY.register(CallbackGauge("chess_batcher_queue_depth", "Positions waiting for each model's batcher", lambda: {
+    (served.role,): served.batcher.stats()["queue_depth"] for served in registry.models()
+}, labelnames=("role",)))
+REGISTRY.register(CallbackGauge("chess_cache_lookups_total", "Position cache lookups", lambda: {("hit",): cache.hits, ("miss",): cache.misses}, labelnames=("result",), kind="counter"))
+REGISTRY.register(CallbackGauge("chess_cache_evictions_total", "Position cache evictions", lambda: cache.evictions, kind="counter"))
+REGISTRY.register(CallbackGauge("chess_process_memory_bytes", "Memory of this process", lambda: {(kind,): value for kind, value in memory_usage().items()}, labelnames=("kind",)))
+
+startup = {
+    "import_s": imported - STARTED,
+    "model_load_s": loaded - imported,
+    "total_s": time.perf_counter() - STARTED
+}
+print(f"Loaded {MODEL_PATH} ({registry.primary.version}) in {startup['model_load_s']:.2f}s (startup {startup['total_s']:.2f}s) | {format_memory(memory_usage())}", flush=True)
+
+def select_move(fen: str, legal_moves: list[str] | None = None, board: torch.Tensor | None = None, route_key: str | None = None) -> str | None:
+    """
+    Picks the engine's move for a position, from the opening book or the cache
+    when possible. Legal moves are generated server-side and the board encoded
+    from the FEN unless given. The model is chosen by the registry, by
+    route_key if given. Blocks until the batcher has evaluated the position.
+    """
+    served = registry.route(route_key)
+    start = time.perf_counter()
+    best_move = choose_move(served, fen, legal_moves, board)
+    elapsed = time.perf_counter() - start
+    MODEL_SECONDS.observe(elapsed, role=served.role, version=served.version)
+    MODEL_REQUESTS.inc(role=served.role, version=served.version)
+    served.record(elapsed)
+    return best_move
+
+def choose_move(served: ServedModel, fen: str, legal_moves: list[str] | None, board: torch.Tensor | None) -> str | None:
+    if legal_moves is None:
+        with STAGE_SECONDS.time(stage="legal_moves"):
+            legal_moves = generate_legal_moves(fen)
+
+    if book is not None and book.meta["model_version"] == served.version:
+        with STAGE_SECONDS.time(stage="book"):
+            best_move = book.best_move(fen, legal_moves)
+        if best_move is not None:
+            return best_move
+
+    key = cache_key(served.version, fen, legal_moves)
+    with STAGE_SECONDS.time(stage="cache"):
+        best_move = cache.get(key)
+    if best_move is None:
+        if board is None:
+            with STAGE_SECONDS.time(stage="encode"):
+                board = encode_board(fen)
+        # Covers queueing, the forward pass and decoding, which are also timed individually by the batcher
+        with STAGE_SECONDS.time(stage="infer"):
+            best_move = served.batcher.infer(board, legal_moves)
+        cache.put(key, best_move)
+    return best_move
+
+def search_move(fen: str, budget: dict) -> tuple[str | None, dict]:
+    """
+    Runs a tree search from the position within the requested node and/or
+    time budget, clamped to the server limits. Raises ValueError on a malformed
+    budget.
+    """
+    nodes = budget.get("nodes", SEARCH_MAX_NODES)
+    time_ms = budget.get("time_ms", SEARCH_MAX_TIME_MS)
+    # bool is an int subclass, but {"nodes": true} is not a budget
+    if isinstance(nodes, bool) or not isinstance(nodes, int) or nodes < 0:
+        raise ValueError("'search.nodes' must be a non-negative integer")
+    if isinstance(time_ms, bool) or not isinstance(time_ms, (int, float)) or not 0 <= time_ms < float("inf"):
+        raise ValueError("'search.time_ms' must be a non-negative number")
+    max_nodes = min(nodes, SEARCH_MAX_NODES)
+    time_ms = min(float(time_ms), SEARCH_MAX_TIME_MS)
+
+    best_move, stats = search(chess.Board(fen), registry.route().evaluator, max_nodes=max_nodes, time_ms=time_ms)
+    return best_move.uci() if best_move is not None else None, stats
+
+def score_positions(boards: list[torch.Tensor], move_lists: list[list[str]], top_k: int) -> list[dict]:
+    """
+    Runs a batch of encoded boards through the model and returns the top_k legal
+    moves of each position with their renormalized probabilities.
+    """
+    served = registry.route()
+    indices, valid = move_indices(move_lists, served.device)
+    if indices.shape[1] == 0:
+        return [{"moves": []} for _ in move_lists]
+
+    with torch.no_grad():
+        logits = served.model(torch.stack(boards).to(served.device))
+        policy = legal_policy(logits, indices, valid)
+        probs, cols = torch.topk(policy, k=min(top_k, policy.shape[1]), dim=1)
+
+    results = []
+    for legal_moves, row_valid, row_probs, row_cols in zip(move_lists, valid.tolist(), probs.tolist(), cols.tolist()):
+        results.append({
+            "moves": [
+                {"move": legal_moves[col], "p": p}
+                for p, col in zip(row_probs, row_cols)
+                if row_valid[col]
+            ]
+        })
+    return results
+
+def require_object(data) -> dict:
+    # JSON bodies may be any value, but every endpoint expects an object
+    if not isinstance(data, dict):
+        raise ValueError("Request body must be a JSON object")
+    return data
+
+def batch_positions(data) -> list:
+    """
+    Reads the positions of a JSON batch request. Raises ValueError unless the
+    body is an object whose 'positions' (if any) is a list.
+    """
+    positions = require_object(data).get("positions", [])
+    if not isinstance(positions, list):
+        raise ValueError("'positions' must be a list")
+    return positions
+
+def resolve_position(data: dict) -> tuple[str, list[str]]:
+    """
+    Reads the position of a request: a FEN, optionally followed by a history of
+    UCI moves played from it (or from the starting position), and optionally
+    the client's list of legal moves, which are generated otherwise. Raises
+    ValueError on malformed input.
+    """
+    fen = require_object(data).get("fen")
+    history = data.get("history")
+    legal_moves = data.get("moves")
+
+    if fen is not None and not isinstance(fen, str):
+        raise ValueError("'fen' must be a string")
+    if legal_moves is not None and (not isinstance(legal_moves, list) or not all(isinstance(uci, str) for uci in legal_moves)):
+        raise ValueError("'moves' must be a list of UCI strings")
+
+    if history is not None:
+        if not isinstance(history, list) or not all(isinstance(uci, str) for uci in history):
+            raise ValueError("'history' must be a list of UCI strings")
+        fen = play_history(fen, history)
+        legal_moves = None # the client's list describes the position before the history
+    elif fen is None:
+        raise ValueError("Missing 'fen'")
+
+    # Generating the moves validates the FEN, also when the client sent its own
+    # list (which is kept); results are cached per position
+    with STAGE_SECONDS.time(stage="legal_moves"):
+        generated = generate_legal_moves(fen)
+    if legal_moves is None:
+        legal_moves = generated
+    # python-chess also accepts FENs the encoder rejects, e.g. en passant on e4 or Shredder castling
+    board_squares(fen)
+
+    return fen, legal_moves
+
+def parse_position(position) -> tuple[torch.Tensor, list[str]]:
+    # NDJSON lines arrive as raw bytes; invalid UTF-8 raises UnicodeDecodeError, a ValueError
+    if isinstance(position, (bytes, str)):
+        position = json.loads(position)
+    if not isinstance(position, dict):
+        raise ValueError("Position must be an object with 'fen' and optionally 'moves'")
+
+    fen, legal_moves = resolve_position(position)
+    return encode_board(fen), legal_moves
+
+def score_chunk(chunk: list, top_k: int, index: int = 0) -> str:
+    """
+    Scores one batch of positions (dicts or raw NDJSON lines) numbered from index
+    and returns their NDJSON result lines.
+    """
+    # Parse positions individually so one bad entry does not fail the whole batch
+    results = [None] * len(chunk)
+    boards, move_lists, rows = [], [], []
+    for offset, position in enumerate(chunk):
+        try:
+            board, legal_moves = parse_position(position)
+        except ValueError as e:
+            results[offset] = {"index": index + offset, "error": str(e)}
+            continue
+        boards.append(board)
+        move_lists.append(legal_moves)
+        rows.append(offset)
+
+    if boards:
+        for offset, scored in zip(rows, score_positions(boards, move_lists, top_k)):
+            results[offset] = {"index": index + offset, **scored}
+
+    return "".join(json.dumps(result) + "\n" for result in results)
+
+def score_stream(positions, top_k: int):
+    """
+    Scores an iterable of positions (dicts or raw NDJSON lines) in batches of
+    BULK_BATCH_SIZE, yielding the NDJSON result lines of each batch. Positions
+    without a move list get their legal moves generated.
+    """
+    positions = iter(positions)
+    index = 0
+    while True:
+        chunk = list(islice(positions, BULK_BATCH_SIZE))
+        if not chunk:
+            break
+        yield score_chunk(chunk, top_k, index)
+        index += len(chunk)
+
+def metrics() -> str:
+    return REGISTRY.render()
+
+def profile(seconds: float) -> str:
+    """
+    Samples all threads for up to PROFILE_MAX_SECONDS and returns the stacks in
+    collapsed flamegraph format.
+    """
+    return sample_stacks(min(max(seconds, 0.1), PROFILE_MAX_SECONDS))
+
+def reply(session_id: str, session: GameSession) -> dict:
+    # The engine's move in a session, played on its board by the model the session is routed to
+    board = session.board
+    fen = board.fen()
+    legal_moves = [move.uci() for move in board.legal_moves]
+    best_move = select_move(fen, legal_moves, session.encoded(), route_key=session_id) if legal_moves else None
+    if best_move is not None:
+        session.push(chess.Move.from_uci(best_move))
+    return {
+        "move": best_move,
+        "fen": board.fen(),
+        "game_over": board.is_game_over()
+    }
+
+def create_session(data: dict) -> dict:
+    """
+    Starts a game from an optional FEN (the starting position otherwise). With
+    "engine_move": true the engine moves first. Raises ValueError on a bad FEN.
+    """
+    fen = require_object(data).get("fen")
+    if fen is not None and not isinstance(fen, str):
+        raise ValueError("'fen' must be a string")
+
+    session_id, session = sessions.create(fen)
+    if data.get("engine_move"):
+        with session.lock:
+            return {"session": session_id, **reply(session_id, session)}
+    return {"session": session_id, "move": None, "fen": session.board.fen(), "game_over": session.board.is_game_over()}
+
+def session_move(session_id: str, data: dict) -> dict | None:
+    """
+    Plays the client's move (UCI) in a session, if any, followed by the
+    engine's reply. Returns None if the session does not exist or expired, and
+    raises ValueError on an illegal move or a body that is not an object.
+    """
+    require_object(data)
+    session = sessions.get(session_id)
+    if session is None:
+        return None
+
+    uci = data.get("move")
+    if uci is not None and not isinstance(uci, str):
+        raise ValueError("'move' must be a UCI string")
+
+    # Concurrent requests on one session are applied one at a time
+    with session.lock:
+        if uci is not None:
+            session.push_uci(uci)
+        return reply(session_id, session)
+
+def stats() -> dict:
+    return {
+        "batcher": registry.primary.batcher.stats(),
+        "models": registry.stats(),
+        "cache": cache.stats(),
+        "book": book.stats() if book is not None else None,
+        "sessions": sessions.stats(),
+        "process": {
+            "pid": os.getpid(),
+            "startup": startup,
+            "memory": memory_usage()
+        }
+    }
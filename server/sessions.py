@@ -0,0 +1,135 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+import chess
+import numpy as np
+import torch
+from dataset import BOARD_SIZE, PLANE_SIZE, PIECE_PLANE_INDEX, chess_board_squares, state_squares
+
+class GameSession:
+    """
+    A game played against the engine. The board's 13x8x8 encoding is kept up
+    to date move by move, by toggling the squares a move changes, instead of
+    being rebuilt from a FEN.
+    """
+
+    def __init__(self, fen: str | None = None):
+        self.board = chess.Board(fen) if fen else chess.Board()
+        self.planes = np.zeros(BOARD_SIZE, dtype=np.uint8)
+        self.planes[chess_board_squares(self.board)] = 1
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    def push(self, move: chess.Move):
+        board = self.board
+        changed = [move.from_square, move.to_square]
+        if board.is_castling(move):
+            # The king lands on the g or c file whether the move is given as e1g1
+            # or king-takes-rook (e1h1), and the rook moves from its corner to
+            # the square the king crossed
+            rank = chess.square_rank(move.from_square)
+            kingside = chess.square_file(move.to_square) > chess.square_file(move.from_square)
+            changed = [
+                move.from_square,
+                chess.square(6 if kingside else 2, rank),
+                chess.square(7 if kingside else 0, rank),
+                chess.square(5 if kingside else 3, rank)
+            ]
+        elif board.is_en_passant(move):
+            changed.append(chess.square(chess.square_file(move.to_square), chess.square_rank(move.from_square)))
+
+        before = [board.piece_at(square) for square in changed]
+        board.push(move)
+
+        for square, old in zip(changed, before):
+            if old is not None:
+                self.planes[PIECE_PLANE_INDEX[old.piece_type, old.color] * PLANE_SIZE + square] = 0
+        for square in changed:
+            new = board.piece_at(square)
+            if new is not None:
+                self.planes[PIECE_PLANE_INDEX[new.piece_type, new.color] * PLANE_SIZE + square] = 1
+
+        # Side to move, castling rights & en passant live in plane 12
+        self.planes[12 * PLANE_SIZE:] = 0
+        self.planes[state_squares(board)] = 1
+
+    def push_uci(self, uci: str):
+        """
+        Plays a move given in UCI notation. Raises ValueError if it is malformed
+        or illegal. Castling given as king-takes-rook is normalized.
+        """
+        try:
+            move = self.board.parse_uci(uci)
+        except ValueError:
+            raise ValueError(f"Illegal move: {uci}")
+        # parse_uci() accepts the null move 0000
+        if not move:
+            raise ValueError(f"Illegal move: {uci}")
+        self.push(move)
+
+    def encoded(self) -> torch.Tensor:
+        return torch.from_numpy(self.planes).view(13, 8, 8).float()
+
+class SessionStore:
+    """
+    Bounded set of game sessions. Sessions idle for longer than ttl_s expire,
+    and the least recently used one is evicted to make room past max_sessions.
+    """
+
+    def __init__(self, max_sessions: int = 10_000, ttl_s: float = 1800):
+        self.max_sessions = max_sessions
+        self.ttl = ttl_s
+
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.created = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def _expire(self, now: float):
+        # Called with the lock held; sessions are ordered by last use, oldest first
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_used <= self.ttl:
+                break
+            self._sessions.popitem(last=False)
+            self.expired += 1
+
+    def create(self, fen: str | None = None) -> tuple[str, GameSession]:
+        session = GameSession(fen)
+        session_id = secrets.token_urlsafe(16)
+
+        with self._lock:
+            self._expire(session.last_used)
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+            self.created += 1
+        return session_id, session
+
+    def get(self, session_id: str) -> GameSession | None:
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_used = now
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def stats(self) -> dict:
+        return {
+            "active": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "ttl_s": self.ttl,
+            "created": self.created,
+            "expired": self.expired,
+            "evictions": self.evictions
+        }
@@ -0,0 +1,20 @@
+import os
+import sys
+import pytest
+
+# The server modules are run as scripts from /server rather than installed
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+START_MOVES = ["e2e4", "d2d4", "g1f3"]
+
+@pytest.fixture(scope="session")
+def model_path(tmp_path_factory) -> str:
+    # Randomly initialized weights, the tests only check the serving contract
+    torch = pytest.importorskip("torch")
+    from engine import ChessEngine
+
+    path = str(tmp_path_factory.mktemp("model") / "model.pt")
+    torch.save(ChessEngine().state_dict(), path)
+    return path
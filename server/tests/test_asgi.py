@@ -0,0 +1,76 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("starlette")
+pytest.importorskip("uvicorn")
+
+from conftest import SERVER_DIR, START_FEN, START_MOVES
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# Runs asgi.py under a real uvicorn process: TestClient does not listen for
+# disconnects while streaming, so it cannot catch a body consumed mid-response
+@pytest.fixture(scope="module")
+def server(model_path):
+    port = free_port()
+    env = {**os.environ, "MODEL_PATH": model_path}
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "asgi:app", "--port", str(port)],
+        cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                urllib.request.urlopen(f"{url}/api/stats", timeout=1).close()
+                break
+            except (urllib.error.URLError, ConnectionError):
+                if process.poll() is not None or time.monotonic() > deadline:
+                    pytest.fail("uvicorn did not start")
+                time.sleep(0.2)
+        yield url
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+def post_ndjson(url: str, body: bytes) -> list[dict]:
+    request = urllib.request.Request(f"{url}/api/batch?k=3", data=body, headers={"Content-Type": "application/x-ndjson"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return [json.loads(line) for line in response.read().splitlines()]
+
+# 2000 lines span many body chunks, with lines split across their boundaries
+@pytest.mark.parametrize("count", [1, 40, 2000])
+def test_ndjson_batch(server, count):
+    line = json.dumps({"fen": START_FEN, "moves": START_MOVES}).encode() + b"\n"
+    results = post_ndjson(server, line * count)
+
+    assert [result["index"] for result in results] == list(range(count))
+    assert all(len(result["moves"]) == 3 for result in results)
+
+def test_ndjson_batch_bad_line(server):
+    line = json.dumps({"fen": START_FEN, "moves": START_MOVES}).encode()
+    results = post_ndjson(server, line + b"\n\xff\xfe\n" + line)
+
+    assert [result["index"] for result in results] == [0, 1, 2]
+    assert "error" in results[1]
+    assert "moves" in results[0] and "moves" in results[2]
+
+def test_process_rejects_fen_the_encoder_cannot_read(server):
+    # Accepted by python-chess, but en passant targets are only on the 3rd & 6th ranks
+    fen = "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR w KQkq e4 0 1"
+    request = urllib.request.Request(f"{server}/api/process", data=json.dumps({"fen": fen}).encode(), headers={"Content-Type": "application/json"})
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(request, timeout=10)
+    assert error.value.code == 400
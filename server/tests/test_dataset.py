@@ -0,0 +1,66 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from torch.utils.data import DataLoader
+from dataset import ChunkedDataset, ChunkShuffleStream
+
+class RangeDataset(ChunkedDataset):
+    # Every sample is its own global index, so batches show exactly what was read
+    def __init__(self, file_sizes: list[int]):
+        self._build_index(file_sizes)
+
+    def load_chunk(self, file_idx):
+        return torch.arange(self.offsets[file_idx], self.offsets[file_idx + 1])
+
+    def chunk_batch(self, chunk, local_indices):
+        samples = chunk[torch.from_numpy(local_indices)]
+        return samples, samples
+
+# Uneven chunks, so workers & ranks end up with different numbers of batches
+FILE_SIZES = [37, 5, 64, 20, 51, 9, 33, 48]
+
+def epoch(stream: ChunkShuffleStream, num_workers: int, skip_batches: int = 0) -> list[torch.Tensor]:
+    stream.set_epoch(1, skip_batches)
+    return [samples for samples, _ in DataLoader(stream, batch_size=None, num_workers=num_workers)]
+
+@pytest.mark.parametrize("num_workers", [0, 3])
+def test_every_sample_once(num_workers):
+    dataset = RangeDataset(FILE_SIZES)
+    batches = epoch(ChunkShuffleStream(dataset, batch_size=16, window=2, seed=3), num_workers)
+
+    assert sorted(torch.cat(batches).tolist()) == list(range(len(dataset)))
+    # Only the last batch of each worker may be short
+    assert sum(len(batch) < 16 for batch in batches) <= max(num_workers, 1)
+
+def test_order_depends_on_the_epoch():
+    stream = ChunkShuffleStream(RangeDataset(FILE_SIZES), batch_size=16, seed=3)
+    first = torch.cat(epoch(stream, 0))
+    stream.set_epoch(2)
+    second = torch.cat([samples for samples, _ in stream])
+
+    assert not torch.equal(first, second)
+
+@pytest.mark.parametrize("num_workers", [0, 2, 3])
+@pytest.mark.parametrize("skip_batches", [1, 5, 14])
+def test_resume_continues_the_epoch(num_workers, skip_batches):
+    stream = ChunkShuffleStream(RangeDataset(FILE_SIZES), batch_size=16, window=2, seed=3)
+    full = epoch(stream, num_workers)
+    resumed = epoch(stream, num_workers, skip_batches)
+
+    assert len(resumed) == len(full) - skip_batches
+    assert all(torch.equal(a, b) for a, b in zip(full[skip_batches:], resumed))
+
+def test_ranks_are_disjoint():
+    dataset = RangeDataset(FILE_SIZES)
+    world_size = 3
+    samples = [
+        torch.cat(epoch(ChunkShuffleStream(dataset, batch_size=16, seed=3, rank=rank, world_size=world_size), 0)).tolist()
+        for rank in range(world_size)
+    ]
+
+    assert sorted(sum(samples, [])) == list(range(len(dataset)))
+
+def test_invalid_rank():
+    with pytest.raises(ValueError):
+        ChunkShuffleStream(RangeDataset(FILE_SIZES), batch_size=16, rank=2, world_size=2)
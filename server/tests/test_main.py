@@ -0,0 +1,35 @@
+import json
+import os
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("flask")
+
+from conftest import START_FEN, START_MOVES
+
+@pytest.fixture(scope="module")
+def client(model_path):
+    # serving loads MODEL_PATH when first imported
+    os.environ["MODEL_PATH"] = model_path
+    import main
+    return main.app.test_client()
+
+def test_ndjson_batch_beyond_the_json_limit(client):
+    import main
+
+    line = json.dumps({"fen": START_FEN, "moves": START_MOVES}).encode() + b"\n"
+    count = main.MAX_CONTENT_LENGTH // len(line) * 3
+    response = client.post("/api/batch?k=2", data=line * count, content_type="application/x-ndjson")
+
+    assert response.status_code == 200
+    results = [json.loads(line) for line in response.get_data().splitlines()]
+    assert [result["index"] for result in results] == list(range(count))
+    assert all(len(result["moves"]) == 2 for result in results)
+
+def test_process_keeps_the_json_limit(client):
+    import main
+
+    body = json.dumps({"fen": START_FEN, "moves": START_MOVES, "padding": "x" * main.MAX_CONTENT_LENGTH})
+    response = client.post("/api/process", data=body, content_type="application/json")
+
+    assert response.status_code == 413
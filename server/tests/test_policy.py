@@ -0,0 +1,56 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+chess = pytest.importorskip("chess")
+
+from dataset import UCI_TO_INDEX, NUM_MOVES
+from policy import move_indices, legal_mask, legal_policy, best_moves
+
+FENS = [
+    "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+    "r3k2r/pppppppp/8/8/8/8/PPPPPPPP/R3K2R w KQkq - 0 1",
+    "8/5pk1/6p1/8/3R4/6P1/5PKP/r7 b - - 3 40"
+]
+
+def legal_moves(fen: str) -> list[str]:
+    return [move.uci() for move in chess.Board(fen).legal_moves]
+
+def masked_softmax(logits: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    # The full policy with illegal moves masked out, renormalized
+    return torch.softmax(logits.masked_fill(~mask, float("-inf")), dim=1)
+
+def test_legal_policy_matches_the_masked_softmax():
+    torch.manual_seed(0)
+    move_lists = [legal_moves(fen) for fen in FENS]
+    logits = torch.randn(len(FENS), NUM_MOVES) * 5
+    indices, valid = move_indices(move_lists)
+
+    policy = legal_policy(logits, indices, valid)
+    expected = masked_softmax(logits, legal_mask(move_lists))
+
+    for row, moves in enumerate(move_lists):
+        columns = torch.tensor([UCI_TO_INDEX[uci] for uci in moves])
+        assert torch.allclose(policy[row, :len(moves)], expected[row, columns], atol=1e-6)
+        # Padding of the shorter lists gets no probability
+        assert torch.all(policy[row, len(moves):] == 0)
+    assert torch.allclose(policy.sum(dim=1), torch.ones(len(FENS)))
+
+def test_legal_mask_marks_the_legal_moves():
+    move_lists = [legal_moves(fen) for fen in FENS]
+    mask = legal_mask(move_lists)
+
+    for row, moves in enumerate(move_lists):
+        assert set(mask[row].nonzero().flatten().tolist()) == {UCI_TO_INDEX[uci] for uci in moves}
+
+def test_best_moves_stays_legal():
+    move_lists = [legal_moves(fen) for fen in FENS] + [[]]
+    logits = torch.zeros(len(move_lists), NUM_MOVES)
+    # The highest logit belongs to a move that is illegal in every position
+    logits[:, UCI_TO_INDEX["a2a5"]] = 100
+    logits[0, UCI_TO_INDEX["g1f3"]] = 10
+
+    moves = best_moves(logits, move_lists)
+
+    assert moves[0] == "g1f3"
+    assert all(move in legal for move, legal in zip(moves[1:-1], move_lists[1:-1]))
+    assert moves[-1] is None
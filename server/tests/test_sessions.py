@@ -0,0 +1,47 @@
+import random
+import pytest
+
+torch = pytest.importorskip("torch")
+chess = pytest.importorskip("chess")
+
+from dataset import encode_board
+from sessions import GameSession
+
+def assert_planes_match(session: GameSession):
+    # The incremental planes must equal a full encoding of the same position
+    assert torch.equal(session.encoded(), encode_board(session.board.fen()))
+
+@pytest.mark.parametrize("fen, moves", [
+    # Castling both ways, including the king-takes-rook form
+    ("r3k2r/pppppppp/8/8/8/8/PPPPPPPP/R3K2R w KQkq - 0 1", ["e1g1", "e8c8"]),
+    ("r3k2r/pppppppp/8/8/8/8/PPPPPPPP/R3K2R w KQkq - 0 1", ["e1a1", "e8h8"]),
+    # A double push sets the en passant square, which is then taken
+    ("4k3/3p4/8/4P3/8/8/8/4K3 b - - 0 1", ["d7d5", "e5d6"]),
+    # Promotion with capture, and a rook capture that removes castling rights
+    ("r3k3/1P6/8/8/8/8/8/4K3 w q - 0 1", ["b7a8q"]),
+    ("r3k3/8/8/8/8/8/8/R3K3 w Qq - 0 1", ["a1a8", "e8e7"])
+])
+def test_special_moves(fen, moves):
+    session = GameSession(fen)
+    assert_planes_match(session)
+    for uci in moves:
+        session.push_uci(uci)
+        assert_planes_match(session)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_games(seed):
+    rng = random.Random(seed)
+    session = GameSession()
+    for _ in range(200):
+        moves = list(session.board.legal_moves)
+        if not moves:
+            break
+        session.push(rng.choice(moves))
+        assert_planes_match(session)
+
+@pytest.mark.parametrize("uci", ["e2e5", "e7e5", "0000", "zz"])
+def test_illegal_moves(uci):
+    session = GameSession()
+    with pytest.raises(ValueError):
+        session.push_uci(uci)
+    assert_planes_match(session)